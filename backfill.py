@@ -0,0 +1,257 @@
+"""
+Historical backfill: imports invoices from archived IMAP folders and/or local PDF
+directories, outside the live loop of main.py.
+
+Usage:
+    python backfill.py --folder "Archive/2022" --folder "Archive/2023" --since 2022-01-01 --until 2024-01-01
+    python backfill.py --path /mnt/old-invoices [--processes 4]
+
+The work is split across --processes shard processes (by UID for IMAP folders, by file
+path for directories). Each shard runs the same pipeline as main.py (Drive upload,
+extraction, Sheets) with its share of the extraction workers and of the Google API rate
+limits. Finished items are recorded in a checkpoint database, so running the same
+command again after an interruption only processes what is left.
+Archived emails are never flagged as read.
+"""
+import os
+import sys
+import zlib
+import datetime
+import queue
+import argparse
+import multiprocessing
+from dotenv import load_dotenv
+from src.email_service import EmailService, InvoiceEmail
+from src.drive_service import DriveService
+from src.extraction_service import ExtractionService
+from src.sheets_service import SheetsService
+from src.pipeline import InvoicePipeline
+from src.dedupe_index import DedupeIndex, state_dir
+from src.job_journal import JobJournal
+from src.extraction_cache import ExtractionCache
+from src.backfill_checkpoint import BackfillCheckpoint
+from src.spool import Spool
+from src import metrics
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Backfills invoices from IMAP folders or local PDF directories")
+    parser.add_argument("--folder", action="append", default=[], help="IMAP folder to import (repeatable)")
+    parser.add_argument("--path", action="append", default=[], help="Local directory of PDFs to import (repeatable)")
+    parser.add_argument("--since", type=datetime.date.fromisoformat, help="First date to include (YYYY-MM-DD)")
+    parser.add_argument("--until", type=datetime.date.fromisoformat, help="First date to exclude (YYYY-MM-DD)")
+    parser.add_argument("--processes", type=int, default=min(4, os.cpu_count() or 1),
+                        help="Shard processes; each opens its own IMAP connection")
+    parser.add_argument("--extract-workers", type=int,
+                        help="Extraction worker processes per shard (default: the cores divided among the shards)")
+    # Defaults stay below the per-user quotas (Sheets: 60 requests/minute)
+    parser.add_argument("--drive-rps", type=float, default=10, help="Drive API requests/second, across all processes")
+    parser.add_argument("--sheets-rps", type=float, default=0.9, help="Sheets API requests/second, across all processes")
+    parser.add_argument("--sheets-batch", type=int, default=200, help="Invoice rows per Sheets append")
+    parser.add_argument("--checkpoint", help="Checkpoint database (default: STATE_DIR/backfill.sqlite3)")
+    args = parser.parse_args(argv)
+    if not args.folder and not args.path:
+        parser.error("give at least one --folder or --path")
+    return args
+
+
+def local_pdfs(root: str, since: datetime.date = None, until: datetime.date = None) -> list:
+    """Paths (relative to root) of the PDFs under root, filtered by modification date."""
+    found = []
+    for directory, _, names in os.walk(root):
+        for name in names:
+            if not name.lower().endswith(".pdf"):
+                continue
+            path = os.path.join(directory, name)
+            modified = datetime.date.fromtimestamp(os.path.getmtime(path))
+            if (since and modified < since) or (until and modified >= until):
+                continue
+            found.append(os.path.relpath(path, root))
+    return sorted(found)
+
+
+def _folder_slug(folder: str) -> str:
+    return "".join(char if char.isalnum() or char in "-_" else "_" for char in folder)
+
+
+class Shard:
+    """One backfill process: its slice of every source, run through its own pipeline."""
+
+    def __init__(self, args, index: int, count: int):
+        self.args = args
+        self.index = index
+        self.count = count
+        self.stats = {"done": 0, "failed": 0, "skipped": 0}
+
+        # 1. This shard's share of the machine and of the API quotas
+        workers = args.extract_workers or max(1, (os.cpu_count() or 1) // count)
+        os.environ["PIPELINE_EXTRACT_WORKERS"] = str(workers)
+        os.environ["GOOGLE_DRIVE_MAX_RPS"] = str(args.drive_rps / count)
+        os.environ["GOOGLE_SHEETS_MAX_RPS"] = str(args.sheets_rps / count)
+        os.environ["SHEETS_FLUSH_ROWS"] = str(args.sheets_batch)
+
+        # 2. Per-process state files; the SQLite stores (dedupe index, extraction cache, checkpoint) are shared
+        shard_dir = os.path.join(state_dir(), "backfill", f"shard-{index}")
+        os.environ["JOURNAL_PATH"] = os.path.join(shard_dir, "journal.jsonl")
+        os.environ["SHEETS_SPILL_PATH"] = os.path.join(shard_dir, "sheets_pending.jsonl")
+        os.environ["DRIVE_INDEX_PATH"] = os.path.join(shard_dir, "drive_index.json")
+        # Spools are per folder (UIDs repeat across folders); the shared tmpfs spool is not
+        os.environ["SPOOL_MEMORY_DIR"] = ""
+        self.shard_dir = shard_dir
+
+        # 3. Metrics are collected here but exported by the parent, which merges every shard's
+        # (one port and one file for the whole backfill)
+        os.environ["METRICS_PORT"] = ""
+        os.environ["METRICS_FILE"] = ""
+        os.environ["METRICS_CYCLE_SUMMARY"] = "false"
+        metrics.configure()
+        self.sheets_service = SheetsService()
+        self.pipeline = InvoicePipeline(
+            DriveService(), ExtractionService(), self.sheets_service,
+            DedupeIndex(), JobJournal(), ExtractionCache()
+        )
+        self.checkpoint = BackfillCheckpoint(args.checkpoint)
+
+    def run(self) -> dict:
+        try:
+            for folder in self.args.folder:
+                self.backfill_folder(folder)
+            for path in self.args.path:
+                self.backfill_directory(path)
+        finally:
+            self.pipeline.shutdown()
+            self.sheets_service.close()
+            self.checkpoint.close()
+        return self.stats
+
+    def backfill_folder(self, folder: str):
+        spool = Spool(os.path.join(self.shard_dir, "spool", _folder_slug(folder)))
+        email_service = EmailService(spool=spool)
+        try:
+            with email_service.session():
+                source = f"imap:{folder}:{email_service.folder_uidvalidity(folder)}"
+                done = self.checkpoint.done_items(source)
+                uids = email_service.search_invoices(folder, self.args.since, self.args.until, unseen_only=False)
+                uids = [uid for uid in uids if int(uid) % self.count == self.index]
+                todo = [uid for uid in uids if uid not in done]
+                self.stats["skipped"] += len(uids) - len(todo)
+                print(f"[shard {self.index}] {folder}: {len(todo)} email(s) to import, {len(uids) - len(todo)} already done")
+
+                try:
+                    for msg, pdf_paths in email_service.iter_invoices(folder, uids=todo):
+                        self.pipeline.submit(msg, pdf_paths)
+                        self._handle_completed(source, spool)
+                finally:
+                    self._handle_completed(source, spool, wait_all=True)
+                    self.sheets_service.flush()
+                    self.pipeline.journal.compact()
+        finally:
+            email_service.link_downloader.close()
+
+    def backfill_directory(self, root: str):
+        root = os.path.abspath(root)
+        source = f"path:{root}"
+        done = self.checkpoint.done_items(source)
+        paths = [
+            path for path in local_pdfs(root, self.args.since, self.args.until)
+            # crc32 rather than hash(): the split must be the same in every run
+            if zlib.crc32(path.encode("utf-8")) % self.count == self.index
+        ]
+        todo = [path for path in paths if path not in done]
+        self.stats["skipped"] += len(paths) - len(todo)
+        print(f"[shard {self.index}] {root}: {len(todo)} PDF(s) to import, {len(paths) - len(todo)} already done")
+
+        try:
+            for path in todo:
+                full_path = os.path.join(root, path)
+                modified = datetime.datetime.fromtimestamp(os.path.getmtime(full_path))
+                self.pipeline.submit(InvoiceEmail(uid=path, subject=path, from_=None, date=modified), [full_path])
+                self._handle_completed(source)
+        finally:
+            self._handle_completed(source, wait_all=True)
+            self.sheets_service.flush()
+            self.pipeline.journal.compact()
+
+    def _handle_completed(self, source: str, spool: Spool = None, wait_all: bool = False):
+        """Checkpoints finished items; failed ones are left for the next run."""
+        for msg, error in self.pipeline.completed(wait_all):
+            if error is None:
+                self.checkpoint.mark_done(source, msg.uid)
+                # Checkpointed items are never resumed from the journal
+                self.pipeline.journal.flag_emails([msg.uid])
+                self.stats["done"] += 1
+            else:
+                print(f"[shard {self.index}] Failed to import '{msg.subject}': {error}")
+                self.stats["failed"] += 1
+            if spool:
+                spool.release(msg.uid, keep=error is not None)
+
+
+def run_shard(args, index: int, count: int, results):
+    stats = {"done": 0, "failed": 0, "skipped": 0, "error": None}
+    try:
+        stats.update(Shard(args, index, count).run())
+    except KeyboardInterrupt:
+        stats["error"] = "interrupted"
+    except Exception as e:
+        print(f"[shard {index}] Backfill stopped: {e}")
+        stats["error"] = str(e)
+    results.put((index, stats, metrics.snapshot()))
+
+
+def main():
+    load_dotenv()
+    args = parse_args()
+    # METRICS_PORT and METRICS_FILE export the totals of all shards, merged as they finish
+    metrics.configure()
+    count = max(1, args.processes)
+    print(f"Backfill started with {count} process(es)")
+
+    # spawn, like the extraction workers: shards start clean instead of inheriting threads
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processes = [
+        context.Process(target=run_shard, args=(args, index, count, results), name=f"backfill-{index}")
+        for index in range(count)
+    ]
+    for process in processes:
+        process.start()
+
+    totals = {"done": 0, "failed": 0, "skipped": 0}
+    errors = []
+    pending = set(range(count))
+    try:
+        while pending:
+            try:
+                index, stats, shard_metrics = results.get(timeout=5)
+            except queue.Empty:
+                # A shard killed by the OOM killer or a crash in native code never reports
+                for index in sorted(pending):
+                    if not processes[index].is_alive() and results.empty():
+                        pending.discard(index)
+                        errors.append(f"shard {index}: exited with code {processes[index].exitcode} without reporting")
+                continue
+            pending.discard(index)
+            metrics.merge(shard_metrics)
+            for key in totals:
+                totals[key] += stats[key]
+            if stats["error"]:
+                errors.append(f"shard {index}: {stats['error']}")
+    except KeyboardInterrupt:
+        # The shards got the same Ctrl+C; they flush their buffered rows before exiting
+        print("Interrupted; waiting for the shards to stop...")
+    finally:
+        for process in processes:
+            process.join()
+        metrics.end_cycle()
+
+    print(f"Backfill finished: {totals['done']} imported, {totals['failed']} failed, "
+          f"{totals['skipped']} already done in an earlier run")
+    for error in errors:
+        print(f"  {error}")
+    if totals["failed"] or errors:
+        print("Run the same command again to retry what is left.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Compares the text-extraction backends of ExtractionService on a directory of invoice PDFs.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_text_backends path/to/invoices [--repeat 3]
+
+Each backend runs in a fresh process so peak RSS is measured independently.
+Reports documents/second, peak resident memory, and how many documents produced
+usable text (see is_usable_text).
+"""
+import os
+import sys
+import time
+import argparse
+import resource
+import multiprocessing
+
+from src.extraction_service import TEXT_BACKENDS, is_usable_text
+
+
+def _run_backend(name: str, pdf_paths: list, repeat: int, results):
+    backend = TEXT_BACKENDS[name]()
+    usable = 0
+    errors = 0
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for pdf_path in pdf_paths:
+            try:
+                text = "\n".join(backend.iter_pages(pdf_path))
+            except Exception:
+                errors += 1
+                continue
+            usable += is_usable_text(text)
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss is reported in kilobytes on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    results.put({
+        "backend": name,
+        "documents": len(pdf_paths) * repeat,
+        "seconds": elapsed,
+        "peak_rss_mb": peak_rss_mb,
+        "usable": usable // repeat,
+        "errors": errors // repeat,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("corpus", help="Directory containing invoice PDFs (searched recursively)")
+    parser.add_argument("--repeat", type=int, default=1, help="Passes over the corpus per backend")
+    parser.add_argument("--backends", nargs="+", default=list(TEXT_BACKENDS), choices=list(TEXT_BACKENDS))
+    args = parser.parse_args()
+
+    pdf_paths = sorted(
+        os.path.join(root, name)
+        for root, _, files in os.walk(args.corpus)
+        for name in files
+        if name.lower().endswith(".pdf")
+    )
+    if not pdf_paths:
+        print(f"No PDFs found in {args.corpus}")
+        sys.exit(1)
+
+    print(f"Corpus: {len(pdf_paths)} PDFs, {args.repeat} pass(es)")
+    print(f"{'backend':<12} {'docs/sec':>10} {'peak RSS MB':>12} {'usable':>8} {'errors':>7}")
+
+    context = multiprocessing.get_context("spawn")
+    for name in args.backends:
+        results = context.Queue()
+        process = context.Process(target=_run_backend, args=(name, pdf_paths, args.repeat, results))
+        process.start()
+        result = results.get()
+        process.join()
+
+        docs_per_sec = result["documents"] / result["seconds"] if result["seconds"] else float("inf")
+        print(
+            f"{result['backend']:<12} {docs_per_sec:>10.1f} {result['peak_rss_mb']:>12.1f} "
+            f"{result['usable']:>4}/{len(pdf_paths):<3} {result['errors']:>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Synthetic corpus of Hungarian invoices for the benchmarks.
+
+Generates invoice PDFs (varied page counts, invoices and díjbekérők, a few recurring
+vendors) and the emails that deliver them: most carry the PDF as an attachment, the
+rest only link to it, like invoice-portal notifications do.
+
+Usage (from the repository root), to write just the PDFs, e.g. for bench_text_backends:
+    python -m benchmarks.corpus path/to/output [--count 100] [--max-pages 6]
+"""
+import os
+import random
+import argparse
+import datetime
+from collections import namedtuple
+from email.message import EmailMessage
+from email.policy import SMTP
+from email.utils import format_datetime
+
+# One generated invoice and the email that delivers it.
+# link_path is the URL path the PDF is served at for link-only emails, None for attachments.
+Invoice = namedtuple("Invoice", ["number", "vendor", "filename", "pdf", "message", "link_path"])
+
+VENDORS = [
+    ("Példa Energia Zrt.", "12345678-2-44", "peldaenergia.hu"),
+    ("Minta Telekom Nyrt.", "87654321-2-41", "mintatelekom.hu"),
+    ("Kovács és Társa Kft.", "11223344-2-13", "kovacsestarsa.hu"),
+    ("Fűtéstechnika Bt.", "22334455-1-05", "futestechnika.hu"),
+    ("Őrség Irodaszer Kft.", "33445566-2-18", "orsegiroda.hu"),
+]
+BUYER = ("Számlázó Automatika Kft.", "99887766-2-42")
+ITEMS = ["Irodaszer csomag", "Szoftver licenc", "Karbantartási díj", "Tanácsadás (óra)", "Áramdíj", "Internet előfizetés"]
+
+# Helvetica with the Latin-2 letters WinAnsi lacks (ő, ű, Ő, Ű) mapped in, so text can be
+# written in ISO-8859-2 and extracts back to proper Hungarian
+FONT = (
+    b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding << /Type /Encoding"
+    b" /BaseEncoding /WinAnsiEncoding /Differences [213 /Ohungarumlaut 219 /Uhungarumlaut"
+    b" 245 /ohungarumlaut 251 /uhungarumlaut] >> >>"
+)
+LINES_PER_PAGE = 50
+
+
+def make_pdf(pages: list) -> bytes:
+    """A minimal text-only PDF; pages is a list of lists of text lines."""
+    objects = [None, None, FONT]
+    page_ids = []
+    for lines in pages:
+        text = b"".join(b"(" + _pdf_escape(line) + b") Tj T* " for line in lines)
+        stream = b"BT /F1 10 Tf 14 TL 50 800 Td " + text + b"ET"
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842]"
+            b" /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id
+        )
+        page_ids.append(len(objects))
+
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    kids = b" ".join(b"%d 0 R" % page_id for page_id in page_ids)
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    out = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def _pdf_escape(line: str) -> bytes:
+    data = line.encode("iso-8859-2", errors="replace")
+    return data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+
+
+def invoice_pages(rng: random.Random, number: str, vendor: tuple, proforma: bool, page_count: int) -> list:
+    name, tax_id, _ = vendor
+    issued = datetime.date(2024, 1, 1) + datetime.timedelta(days=rng.randrange(365))
+    due = issued + datetime.timedelta(days=rng.choice((8, 15, 30)))
+
+    # Both common Hungarian labels of the invoice number
+    number_label = "Díjbekérő száma" if proforma else rng.choice(("Számla száma", "Számla sorszáma", "Sorszám"))
+
+    header = [
+        "DÍJBEKÉRŐ" if proforma else "SZÁMLA",
+        f"Szállító neve: {name}",
+        f"Adószám: {tax_id}",
+        "1234 Budapest, Fő utca 1.",
+        f"{number_label}: {number}",
+        f"Kiállítás dátuma: {issued:%Y.%m.%d.}",
+        f"Fizetési határidő: {due:%Y.%m.%d.}",
+        f"Vevő neve: {BUYER[0]}",
+        f"Vevő adószáma: {BUYER[1]}",
+        "",
+        "Tétel megnevezése                Mennyiség    Nettó ár    ÁFA",
+    ]
+
+    # Fill the pages with items; the total is on the last page
+    item_lines = max(page_count * LINES_PER_PAGE - len(header) - 6, 1) if page_count > 1 else rng.randrange(3, 15)
+    lines = list(header)
+    total = 0
+    for _ in range(item_lines):
+        quantity = rng.randrange(1, 10)
+        price = rng.randrange(1, 200) * 500
+        total += quantity * price
+        lines.append(f"{rng.choice(ITEMS):<32} {quantity:>5} db {price:>10,} Ft    27%".replace(",", " "))
+    gross = round(total * 1.27)
+    lines += [
+        "",
+        f"Nettó összesen: {total:,} Ft".replace(",", " "),
+        f"ÁFA összesen: {gross - total:,} Ft".replace(",", " "),
+        f"Fizetendő összeg: {gross:,} Ft".replace(",", " "),
+    ]
+    return [lines[i:i + LINES_PER_PAGE] for i in range(0, len(lines), LINES_PER_PAGE)]
+
+
+def generate(count: int, link_ratio: float = 0.3, max_pages: int = 6, seed: int = 1, link_base_url: str = "") -> list:
+    """Generates count invoices with their emails. Link-only emails point to link_base_url + link_path."""
+    rng = random.Random(seed)
+    invoices = []
+    for i in range(count):
+        vendor = rng.choice(VENDORS)
+        proforma = rng.random() < 0.1
+        number = f"{'DB' if proforma else 'SZ'}-2024/{i + 1:05d}"
+        page_count = rng.choice([1] * 6 + list(range(2, max_pages + 1)))
+        pdf = make_pdf(invoice_pages(rng, number, vendor, proforma, page_count))
+        # Vendors reuse one file name for every invoice, like real billing systems do
+        filename = "szamla.pdf" if rng.random() < 0.5 else f"szamla_{i + 1:05d}.pdf"
+        link_path = f"/invoices/{i + 1:05d}/{filename}" if rng.random() < link_ratio else None
+        message = _email(rng, i, number, vendor, filename, pdf, link_base_url + link_path if link_path else None)
+        invoices.append(Invoice(number, vendor[0], filename, pdf, message, link_path))
+    return invoices
+
+
+def _email(rng: random.Random, index: int, number: str, vendor: tuple, filename: str, pdf: bytes, link: str) -> bytes:
+    name, _, domain = vendor
+    msg = EmailMessage()
+    msg["Subject"] = f"Új számla érkezett: {number}"
+    msg["From"] = f"{name} <szamla@{domain}>"
+    msg["To"] = "konyveles@example.hu"
+    msg["Date"] = format_datetime(datetime.datetime(2024, 1, 1, 8, 0, tzinfo=datetime.timezone.utc) + datetime.timedelta(minutes=index))
+    msg["Message-ID"] = f"<invoice-{index}@{domain}>"
+
+    if link:
+        msg.set_content(f"Tisztelt Partnerünk! Számláját letöltheti: {link}", cte="base64")
+        msg.add_alternative(
+            f'<html><body><p>Tisztelt Partnerünk!</p><p><a href="{link}">Számla letöltése</a></p>'
+            f'<p><a href="https://{domain}/adatvedelem">Adatvédelem</a></p></body></html>',
+            subtype="html", cte="base64",
+        )
+    else:
+        msg.set_content(f"Tisztelt Partnerünk! Mellékelten küldjük a(z) {number} számlát.", cte="base64")
+        msg.add_attachment(pdf, maintype="application", subtype="pdf", filename=filename)
+    # IMAP serves messages with CRLF line endings
+    return msg.as_bytes(policy=SMTP)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Writes synthetic Hungarian invoice PDFs")
+    parser.add_argument("output", help="Directory to write the PDFs to")
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--max-pages", type=int, default=6)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    for invoice in generate(args.count, link_ratio=0, max_pages=args.max_pages, seed=args.seed):
+        with open(os.path.join(args.output, invoice.number.replace("/", "_") + ".pdf"), "wb") as f:
+            f.write(invoice.pdf)
+    print(f"Wrote {args.count} PDFs to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+Local HTTP stand-ins for the benchmark: a server for invoice download links, and a fake
+of the Google endpoints DriveService and SheetsService use (OAuth token, Drive files,
+changes and uploads, Sheets values get/batchGet/append).
+
+Both add a fixed latency to every request. The Google fake also answers a configurable
+share of API requests (never the token endpoint) with 429, like quota errors do.
+"""
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+from email.parser import BytesParser
+from email.policy import compat32
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+A1_RANGE = re.compile(r"^(?:[^!]+!)?([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?$")
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, latency: float = 0.0):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status: int, body: bytes, content_type: str = "application/json", headers: dict = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def send_json(self, status: int, data: dict, headers: dict = None):
+        self.send_body(status, json.dumps(data).encode("utf-8"), headers=headers)
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def begin(self):
+        with self.server.lock:
+            self.server.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+
+class LinkServer(_Server):
+    """Serves invoice PDFs at the link paths of the corpus."""
+
+    def __init__(self, files: dict, latency: float = 0.0):
+        super().__init__(_LinkHandler, latency)
+        # URL path -> (file name, PDF bytes)
+        self.files = files
+
+
+class _LinkHandler(_Handler):
+    def do_GET(self):
+        self.begin()
+        entry = self.server.files.get(urlsplit(self.path).path)
+        if entry is None:
+            self.send_body(404, b"Not found", "text/plain")
+            return
+        filename, pdf = entry
+        self.send_body(200, pdf, "application/pdf", {"Content-Disposition": f'attachment; filename="{filename}"'})
+
+    do_HEAD = do_GET
+
+
+class FakeGoogle(_Server):
+    """
+    In-memory Drive folder and spreadsheet. Point the clients at it with
+    GOOGLE_API_BASE_URL and a service account whose token_uri is on the same server.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: int = 1):
+        super().__init__(_GoogleHandler, latency)
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.throttled = 0
+        self.files = []
+        self.uploads = {}
+        self.rows = []
+        self.log_rows = []
+
+    def throttle(self) -> bool:
+        with self.lock:
+            if self.random.random() < self.error_rate:
+                self.throttled += 1
+                return True
+        return False
+
+
+class _GoogleHandler(_Handler):
+    def do_GET(self):
+        self.handle_api()
+
+    def do_POST(self):
+        self.handle_api()
+
+    def do_PUT(self):
+        self.handle_api()
+
+    def handle_api(self):
+        self.begin()
+        url = urlsplit(self.path)
+        path, query = unquote(url.path), parse_qs(url.query)
+        body = self.read_body()
+
+        if path == "/token":
+            self.send_json(200, {"access_token": "benchmark", "expires_in": 3600, "token_type": "Bearer"})
+            return
+        if self.server.throttle():
+            self.send_json(429, {"error": {"code": 429, "message": "Rate limit exceeded", "status": "RESOURCE_EXHAUSTED"}})
+            return
+
+        if path == "/drive/v3/changes/startPageToken":
+            self.send_json(200, {"startPageToken": "1"})
+        elif path == "/drive/v3/changes":
+            self.send_json(200, {"changes": [], "newStartPageToken": "1"})
+        elif path == "/drive/v3/files" and self.command == "GET":
+            with self.server.lock:
+                files = list(self.server.files)
+            self.send_json(200, {"files": files})
+        elif path == "/upload/drive/v3/files":
+            self.upload(query, body)
+        elif path.startswith("/v4/spreadsheets/"):
+            self.sheets(path.split("/", 4)[4], query, body)
+        else:
+            self.send_json(404, {"error": {"code": 404, "message": f"Unknown endpoint {path}"}})
+
+    def upload(self, query: dict, body: bytes):
+        upload_type = query.get("uploadType", [""])[0]
+        if upload_type == "multipart":
+            message = BytesParser(policy=compat32).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body
+            )
+            parts = message.get_payload() if message.is_multipart() else []
+            content = parts[1].get_payload(decode=True) if len(parts) > 1 else body
+            self.send_json(200, self.add_file(content))
+        elif upload_type == "resumable" and "upload_id" not in query:
+            with self.server.lock:
+                upload_id = str(len(self.server.uploads) + 1)
+                self.server.uploads[upload_id] = bytearray()
+            self.send_json(200, {}, {"Location": f"{self.server.url}/upload/drive/v3/files?uploadType=resumable&upload_id={upload_id}"})
+        elif upload_type == "resumable":
+            data = self.server.uploads[query["upload_id"][0]]
+            data += body
+            # "bytes 0-8388607/20000000", or "bytes */20000000" for the final empty chunk
+            total = (self.headers.get("Content-Range") or "").rpartition("/")[2]
+            if total.isdigit() and len(data) < int(total):
+                self.send_body(308, b"", "text/plain", {"Range": f"bytes=0-{len(data) - 1}"})
+            else:
+                self.send_json(200, self.add_file(bytes(data)))
+        else:
+            self.send_json(400, {"error": {"code": 400, "message": f"Unsupported uploadType {upload_type}"}})
+
+    def add_file(self, content: bytes) -> dict:
+        with self.server.lock:
+            file_id = f"file{len(self.server.files) + 1}"
+            entry = {
+                "id": file_id,
+                "name": file_id + ".pdf",
+                "md5Checksum": hashlib.md5(content).hexdigest(),
+                "webViewLink": f"https://drive.google.com/file/d/{file_id}/view",
+            }
+            self.server.files.append(entry)
+        return entry
+
+    def sheets(self, rest: str, query: dict, body: bytes):
+        # rest: "values/<range>", "values/<range>:append" or "values:batchGet"
+        if rest == "values:batchGet":
+            ranges = [self.read_range(name) for name in query.get("ranges", [])]
+            self.send_json(200, {"valueRanges": [{"values": values} for values in ranges]})
+        elif rest.startswith("values/") and rest.endswith(":append"):
+            range_name = rest[len("values/"):-len(":append")]
+            values = json.loads(body or b"{}").get("values", [])
+            target = self.server.log_rows if "!" in range_name else self.server.rows
+            with self.server.lock:
+                start = len(target) + 1
+                target.extend(values)
+                end = len(target)
+            self.send_json(200, {"updates": {"updatedRange": f"Sheet1!A{start}:I{end}", "updatedRows": len(values)}})
+        elif rest.startswith("values/"):
+            self.send_json(200, {"values": self.read_range(rest[len("values/"):])})
+        else:
+            self.send_json(404, {"error": {"code": 404, "message": f"Unknown endpoint {rest}"}})
+
+    def read_range(self, range_name: str) -> list:
+        """Values of an A1 range like B:D, B12:D12 or B13:D of the invoice rows."""
+        match = A1_RANGE.match(range_name)
+        if not match:
+            return []
+        first_column, first_row, last_column, last_row = match.groups()
+        first = _column_index(first_column)
+        last = _column_index(last_column or first_column)
+        with self.server.lock:
+            rows = self.server.rows[int(first_row or 1) - 1:int(last_row) if last_row else None]
+            return [row[first:last + 1] for row in rows]
+
+
+def _column_index(column: str) -> int:
+    index = 0
+    for char in column:
+        index = index * 26 + ord(char) - ord("A") + 1
+    return index - 1
@@ -0,0 +1,311 @@
+"""
+Minimal in-memory IMAP4rev1 server, enough for EmailService: LOGIN, SELECT, UID SEARCH,
+UID FETCH (BODYSTRUCTURE, HEADER.FIELDS and partial BODY.PEEK[section]<offset.length>),
+UID STORE, STATUS and LOGOUT, over plain TCP. SEARCH supports the criteria EmailService sends:
+CHARSET, ALL, SEEN/UNSEEN, SUBJECT/FROM, SINCE/BEFORE/ON (against the Date header),
+NOT, OR and parenthesised lists; anything else is answered with BAD, as a server would.
+"""
+import re
+import time
+import datetime
+import threading
+import socketserver
+from email import message_from_bytes
+from email.header import decode_header, make_header
+from email.policy import compat32
+from email.utils import parsedate_to_datetime
+
+HEADER_FIELDS = ("Subject", "From", "Date")
+LITERAL_SUFFIX = re.compile(rb"\{(\d+)(\+?)\}\r\n$")
+PARTIAL_BODY = re.compile(r"BODY\.PEEK\[([\d.]+)\]<(\d+)\.(\d+)>", re.IGNORECASE)
+SEARCH_TOKEN = re.compile(r'\s*(\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+)')
+
+
+class StoredMessage:
+    """A message with its precomputed BODYSTRUCTURE, header block and encoded sections."""
+
+    def __init__(self, uid: int, raw: bytes):
+        self.uid = uid
+        self.seen = False
+        message = message_from_bytes(raw, policy=compat32)
+        self.sections = {}
+        self.bodystructure = _structure(message, "", self.sections)
+        self.headers = b"".join(
+            f"{name}: {message[name]}\r\n".encode("utf-8") for name in HEADER_FIELDS if message[name]
+        ) + b"\r\n"
+        # Decoded, for SEARCH
+        self.subject = str(make_header(decode_header(message["Subject"] or "")))
+        self.sender = str(make_header(decode_header(message["From"] or "")))
+        self.date = parsedate_to_datetime(message["Date"]).date() if message["Date"] else None
+
+
+class SearchError(ValueError):
+    pass
+
+
+def parse_search(args: str):
+    """Parses SEARCH criteria into a predicate over StoredMessage; raises SearchError when invalid."""
+    tokens = SEARCH_TOKEN.findall(args)
+    if "".join(tokens) != re.sub(r"\s", "", args):
+        raise SearchError(f"Unparsable criteria: {args}")
+    if len(tokens) >= 2 and tokens[0].upper() == "CHARSET":
+        # Strings arrive already decoded from UTF-8; US-ASCII is a subset of it
+        if tokens[1].strip('"').upper() not in ("UTF-8", "US-ASCII"):
+            raise SearchError(f"Unsupported charset {tokens[1]}")
+        tokens = tokens[2:]
+    position = [0]
+
+    def next_token() -> str:
+        if position[0] >= len(tokens):
+            raise SearchError("Criteria end too early")
+        position[0] += 1
+        return tokens[position[0] - 1]
+
+    def string() -> str:
+        token = next_token()
+        if token.startswith('"'):
+            return re.sub(r"\\(.)", r"\1", token[1:-1])
+        return token
+
+    def date() -> datetime.date:
+        value = string()
+        try:
+            return datetime.datetime.strptime(value, "%d-%b-%Y").date()
+        except ValueError:
+            raise SearchError(f"Invalid date {value}")
+
+    def key():
+        token = next_token()
+        name = token.upper()
+        if token == "(":
+            keys = []
+            while position[0] < len(tokens) and tokens[position[0]] != ")":
+                keys.append(key())
+            next_token()
+            return lambda m: all(k(m) for k in keys)
+        if name == "ALL":
+            return lambda m: True
+        if name in ("SEEN", "UNSEEN"):
+            wanted = name == "SEEN"
+            return lambda m: m.seen == wanted
+        if name in ("SUBJECT", "FROM"):
+            needle = string().lower()
+            if name == "SUBJECT":
+                return lambda m: needle in m.subject.lower()
+            return lambda m: needle in m.sender.lower()
+        if name in ("SINCE", "BEFORE", "ON"):
+            day = date()
+            return {
+                "SINCE": lambda m: m.date is not None and m.date >= day,
+                "BEFORE": lambda m: m.date is not None and m.date < day,
+                "ON": lambda m: m.date == day,
+            }[name]
+        if name == "NOT":
+            inner = key()
+            return lambda m: not inner(m)
+        if name == "OR":
+            left, right = key(), key()
+            return lambda m: left(m) or right(m)
+        raise SearchError(f"Unsupported search key {token}")
+
+    keys = []
+    while position[0] < len(tokens):
+        keys.append(key())
+    if not keys:
+        raise SearchError("No search criteria")
+    return lambda m: all(k(m) for k in keys)
+
+
+def _quote(value) -> str:
+    if value is None:
+        return "NIL"
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _param_list(pairs) -> str:
+    if not pairs:
+        return "NIL"
+    return "(" + " ".join(f"{_quote(key.upper())} {_quote(value)}" for key, value in pairs) + ")"
+
+
+def _structure(part, section: str, sections: dict) -> str:
+    if part.is_multipart():
+        children = "".join(
+            _structure(child, f"{section}.{i}" if section else str(i), sections)
+            for i, child in enumerate(part.get_payload(), 1)
+        )
+        boundary = _param_list([("boundary", part.get_boundary())])
+        return f"({children} {_quote(part.get_content_subtype().upper())} {boundary} NIL NIL)"
+
+    body = part.get_payload(decode=False)
+    encoded = body.encode("ascii", errors="surrogateescape") if isinstance(body, str) else bytes(body)
+    sections[section or "1"] = encoded
+
+    main_type, sub_type = part.get_content_maintype(), part.get_content_subtype()
+    params = _param_list([(key, value) for key, value in (part.get_params() or [])[1:]])
+    encoding = _quote((part.get("Content-Transfer-Encoding") or "7bit").upper())
+    fields = f"{_quote(main_type.upper())} {_quote(sub_type.upper())} {params} NIL NIL {encoding} {len(encoded)}"
+    if main_type == "text":
+        fields += " %d" % encoded.count(b"\n")
+
+    disposition = "NIL"
+    if part.get("Content-Disposition"):
+        value = part.get("Content-Disposition").split(";")[0].strip()
+        filename = part.get_param("filename", header="content-disposition")
+        disposition = f"({_quote(value.upper())} {_param_list([('filename', filename)] if filename else [])})"
+    return f"({fields} NIL {disposition} NIL)"
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages: list, latency: float = 0.0):
+        super().__init__(("127.0.0.1", 0), _ImapHandler)
+        self.messages = {uid: StoredMessage(uid, raw) for uid, raw in enumerate(messages, start=1)}
+        # Added to every command, to model the round trip to a remote server
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.commands = 0
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake-imap", daemon=True).start()
+        return self
+
+
+class _ImapHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.send(b"* OK [CAPABILITY IMAP4rev1 IDLE] Fake IMAP ready")
+        while True:
+            command = self.read_command()
+            if command is None:
+                return
+            parts = command.split(b" ", 2)
+            if len(parts) < 2:
+                continue
+            tag, name = parts[0], parts[1].upper().decode("ascii", "replace")
+            args = parts[2] if len(parts) > 2 else b""
+
+            with self.server.lock:
+                self.server.commands += 1
+            if self.server.latency:
+                time.sleep(self.server.latency)
+
+            if name == "UID":
+                sub, _, args = args.partition(b" ")
+                name = "UID " + sub.upper().decode("ascii", "replace")
+
+            if name == "LOGOUT":
+                self.send(b"* BYE logging out")
+                self.send(tag + b" OK LOGOUT completed")
+                return
+            handler = {
+                "CAPABILITY": self.capability,
+                "SELECT": self.select,
+                "EXAMINE": self.select,
+                "UID SEARCH": self.search,
+                "UID FETCH": self.fetch,
+                "UID STORE": self.store,
+                "STATUS": self.status,
+            }.get(name)
+            if handler:
+                error = handler(args.decode("utf-8", "replace"))
+                if error:
+                    self.send(tag + b" BAD " + error.encode("utf-8", "replace"))
+                    continue
+            # LOGIN, NOOP, CLOSE and anything else simply succeed
+            self.send(tag + b" OK " + name.encode() + b" completed")
+
+    def read_command(self):
+        """Reads one command line, including any literals it carries."""
+        data = b""
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return None
+            data += line
+            match = LITERAL_SUFFIX.search(line)
+            if not match:
+                return data.rstrip(b"\r\n")
+            if not match.group(2):
+                self.send(b"+ Ready for literal")
+            data += self.rfile.read(int(match.group(1)))
+
+    def send(self, line: bytes):
+        self.wfile.write(line + b"\r\n")
+
+    def capability(self, args: str):
+        self.send(b"* CAPABILITY IMAP4rev1 IDLE")
+
+    def select(self, args: str):
+        self.send(b"* %d EXISTS" % len(self.server.messages))
+        self.send(b"* 0 RECENT")
+        self.send(b"* OK [UIDVALIDITY 1] UIDs valid")
+        self.send(b"* FLAGS (\\Seen \\Answered \\Flagged \\Deleted \\Draft)")
+
+    def status(self, args: str):
+        name, _, items = args.rpartition(" (")
+        with self.server.lock:
+            values = {
+                "MESSAGES": len(self.server.messages),
+                "UIDNEXT": max(self.server.messages, default=0) + 1,
+                "UIDVALIDITY": 1,
+                "UNSEEN": sum(1 for message in self.server.messages.values() if not message.seen),
+                "RECENT": 0,
+            }
+        requested = [item for item in items.rstrip(")").upper().split() if item in values]
+        self.send(f"* STATUS {name} ({' '.join(f'{item} {values[item]}' for item in requested)})".encode("utf-8"))
+
+    def search(self, args: str):
+        try:
+            matches = parse_search(args)
+        except SearchError as e:
+            return str(e)
+        with self.server.lock:
+            uids = [str(uid) for uid, message in self.server.messages.items() if matches(message)]
+        self.send(("* SEARCH " + " ".join(uids)).rstrip().encode())
+
+    def fetch(self, args: str):
+        uid_set, _, items = args.partition(" ")
+        partial = PARTIAL_BODY.search(items)
+        for uid in self._uids(uid_set):
+            message = self.server.messages[uid]
+            if partial:
+                section, offset, length = partial.group(1), int(partial.group(2)), int(partial.group(3))
+                data = message.sections.get(section, b"")[offset:offset + length]
+                self._send_fetch(uid, f"UID {uid} BODY[{section}]<{offset}>", data)
+                continue
+
+            prefix = f"UID {uid}"
+            if "BODYSTRUCTURE" in items.upper():
+                prefix += f" BODYSTRUCTURE {message.bodystructure}"
+            if "HEADER.FIELDS" in items.upper():
+                fields = " ".join(name.upper() for name in HEADER_FIELDS)
+                self._send_fetch(uid, prefix + f" BODY[HEADER.FIELDS ({fields})]", message.headers)
+            else:
+                self.send(f"* {uid} FETCH ({prefix})".encode())
+
+    def store(self, args: str):
+        uid_set, _, rest = args.partition(" ")
+        seen = "\\SEEN" in rest.upper()
+        with self.server.lock:
+            for uid in self._uids(uid_set):
+                if seen:
+                    self.server.messages[uid].seen = not rest.startswith("-")
+
+    def _send_fetch(self, uid: int, prefix: str, literal: bytes):
+        self.wfile.write(f"* {uid} FETCH ({prefix} {{{len(literal)}}}\r\n".encode() + literal + b")\r\n")
+
+    def _uids(self, uid_set: str) -> list:
+        uids = []
+        last = max(self.server.messages) if self.server.messages else 0
+        for item in uid_set.split(","):
+            start, _, end = item.partition(":")
+            start = last if start == "*" else int(start)
+            end = start if not end else (last if end == "*" else int(end))
+            uids.extend(uid for uid in range(min(start, end), max(start, end) + 1) if uid in self.server.messages)
+        return uids
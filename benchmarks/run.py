@@ -0,0 +1,218 @@
+"""
+End-to-end benchmark of one processing cycle against local stand-ins, no accounts needed.
+
+Generates a synthetic corpus of Hungarian invoice emails (see benchmarks/corpus.py), serves
+it from a local IMAP server, serves the link-only invoices over HTTP and points Drive and
+Sheets at an in-memory fake with configurable latency and 429 injection. Then runs
+main.run_cycle with the same services main() builds and reports invoices/second,
+per-stage latency percentiles and peak RSS.
+
+Usage (from the repository root):
+    python -m benchmarks.run [--emails 200] [--latency-ms 20] [--error-rate 0.02] [--json out.json]
+
+Everything runs in a temporary directory, so the local state/ and downloads/ are not touched.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import contextlib
+
+import main as app
+from src import metrics
+from src.email_service import EmailService
+from src.drive_service import DriveService
+from src.extraction_service import ExtractionService
+from src.notification_service import NotificationService
+from src.sheets_service import SheetsService
+from src.pipeline import InvoicePipeline
+from src.dedupe_index import DedupeIndex
+from src.job_journal import JobJournal
+from src.extraction_cache import ExtractionCache
+from benchmarks import corpus
+from benchmarks.fake_http import FakeGoogle, LinkServer
+from benchmarks.fake_imap import FakeImapServer
+
+PERCENTILES = (50, 90, 99)
+
+
+def service_account_info(token_uri: str) -> dict:
+    """A service account with a throwaway key; google-auth needs a real RSA key to sign its token request."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode("ascii")
+    return {
+        "type": "service_account",
+        "project_id": "benchmark",
+        "private_key_id": "benchmark",
+        "private_key": pem,
+        "client_email": "benchmark@benchmark.iam.gserviceaccount.com",
+        "client_id": "0",
+        "token_uri": token_uri,
+    }
+
+
+def percentile(values: list, p: float) -> float:
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    rank = max(int(round(p / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(args, workdir: str) -> dict:
+    latency = args.latency_ms / 1000
+
+    # 1. Corpus and stand-ins
+    link_server = LinkServer({}, latency).start()
+    invoices = corpus.generate(args.emails, args.link_ratio, args.max_pages, args.seed, link_server.url)
+    link_server.files.update({inv.link_path: (inv.filename, inv.pdf) for inv in invoices if inv.link_path})
+    imap = FakeImapServer([inv.message for inv in invoices], latency).start()
+    google = FakeGoogle(latency, args.error_rate, args.seed).start()
+
+    # 2. Environment, read by the services' constructors and metrics.configure()
+    os.environ.update({
+        "STATE_DIR": os.path.join(workdir, "state"),
+        "SPOOL_DIR": os.path.join(workdir, "downloads"),
+        "SPOOL_MEMORY_DIR": "",
+        "EMAIL_HOST": "127.0.0.1",
+        "EMAIL_IMAP_PORT": str(imap.port),
+        "EMAIL_IMAP_SSL": "false",
+        "EMAIL_USER": "benchmark",
+        "EMAIL_PASSWORD": "benchmark",
+        "EMAIL_USE_IDLE": "false",
+        # No alert emails from the benchmark
+        "ALERT_EMAIL": "",
+        "GOOGLE_SERVICE_ACCOUNT_JSON": json.dumps(service_account_info(google.url + "/token")),
+        "GOOGLE_SERVICE_ACCOUNT_FILE": "",
+        "GOOGLE_API_BASE_URL": google.url,
+        "GOOGLE_DRIVE_FOLDER_ID": "benchmark-folder",
+        "GOOGLE_SHEET_ID": "benchmark-sheet",
+        "EXTRACTION_TEMPLATES_PATH": os.path.join(workdir, "vendor_templates.json"),
+        "METRICS_ENABLED": "true",
+        "METRICS_KEEP_SAMPLES": "true",
+        "METRICS_FILE": "",
+        "METRICS_PORT": "",
+        "METRICS_CYCLE_SUMMARY": "false",
+    })
+
+    metrics.configure()
+
+    # 3. The services main() builds, then one cycle over the whole corpus
+    setup_start = time.perf_counter()
+    notification_service = NotificationService()
+    email_service = EmailService()
+    drive_service = DriveService()
+    sheets_service = SheetsService()
+    journal = JobJournal()
+    pipeline = InvoicePipeline(
+        drive_service, ExtractionService(), sheets_service, DedupeIndex(), journal, ExtractionCache()
+    )
+    email_service.on_flagged = journal.flag_emails
+    setup_seconds = time.perf_counter() - setup_start
+
+    start = time.perf_counter()
+    with metrics.timer("cycle"):
+        app.run_cycle(email_service, drive_service, pipeline, sheets_service, notification_service)
+    elapsed = time.perf_counter() - start
+    journal.compact()
+
+    pipeline.shutdown()
+    sheets_service.close()
+    email_service.link_downloader.close()
+
+    # 4. Results; children's peak RSS covers the extraction workers, which have exited by now
+    recorded = len(google.rows)
+    stages = {
+        stage: {"calls": len(values), **{f"p{p}": percentile(values, p) for p in PERCENTILES}}
+        for stage, values in sorted(metrics.samples().items())
+    }
+    return {
+        "revision": git_revision(),
+        "emails": args.emails,
+        "link_emails": sum(1 for inv in invoices if inv.link_path),
+        "latency_ms": args.latency_ms,
+        "error_rate": args.error_rate,
+        "invoices_recorded": recorded,
+        "setup_seconds": round(setup_seconds, 3),
+        "cycle_seconds": round(elapsed, 3),
+        "invoices_per_second": round(recorded / elapsed, 2) if elapsed else 0.0,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "peak_worker_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        "stages": stages,
+        "servers": {
+            "imap_commands": imap.commands,
+            "link_requests": link_server.requests,
+            "google_requests": google.requests,
+            "google_throttled": google.throttled,
+            "drive_files": len(google.files),
+        },
+    }
+
+
+def print_report(result: dict):
+    print(f"Revision {result['revision']}: {result['emails']} emails ({result['link_emails']} link-only), "
+          f"{result['latency_ms']} ms latency, {result['error_rate']:.0%} 429s")
+    print(f"  Invoices recorded:   {result['invoices_recorded']}")
+    print(f"  Setup:               {result['setup_seconds']:.2f} s")
+    print(f"  Cycle:               {result['cycle_seconds']:.2f} s")
+    print(f"  Throughput:          {result['invoices_per_second']:.2f} invoices/s")
+    print(f"  Peak RSS:            {result['peak_rss_mb']:.1f} MB (extraction workers {result['peak_worker_rss_mb']:.1f} MB)")
+    print(f"  Servers:             {result['servers']}")
+    print()
+    print(f"  {'stage':<16} {'calls':>6}" + "".join(f" {'p%d ms' % p:>9}" for p in PERCENTILES))
+    for stage, row in result["stages"].items():
+        print(f"  {stage:<16} {row['calls']:>6}" + "".join(f" {row['p%d' % p] * 1000:>9.1f}" for p in PERCENTILES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks one processing cycle against local IMAP, HTTP, Drive and Sheets stand-ins")
+    parser.add_argument("--emails", type=int, default=200)
+    parser.add_argument("--link-ratio", type=float, default=0.3, help="Share of emails that only link to their PDF")
+    parser.add_argument("--max-pages", type=int, default=6)
+    parser.add_argument("--latency-ms", type=float, default=20, help="Added to every IMAP command and HTTP request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of Google API requests answered with 429")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="Also write the results to this file, for comparing runs")
+    parser.add_argument("--keep", action="store_true", help="Keep the working directory (state, spool, run.log)")
+    parser.add_argument("--verbose", action="store_true", help="Show the services' output instead of writing it to run.log")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="invoice-benchmark-")
+    try:
+        if args.verbose:
+            result = run(args, workdir)
+        else:
+            with open(os.path.join(workdir, "run.log"), "w", encoding="utf-8") as log, contextlib.redirect_stdout(log):
+                result = run(args, workdir)
+    finally:
+        if args.keep:
+            print(f"Working directory kept: {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,94 @@
 import os
+import sys
 import time
+import signal
 import datetime
 import traceback
 from dotenv import load_dotenv
 from src.email_service import EmailService
 from src.drive_service import DriveService
-from src.email_service import EmailService
-from src.drive_service import DriveService
 from src.extraction_service import ExtractionService
 # from src.notion_service import NotionService # Deprecated
 from src.notification_service import NotificationService
 from src.sheets_service import SheetsService
+from src.pipeline import InvoicePipeline
+from src.dedupe_index import DedupeIndex
+from src.job_journal import JobJournal
+from src.extraction_cache import ExtractionCache
+from src import metrics
+
+# Working hours window (inclusive hours)
+WORK_START_HOUR = 7
+WORK_END_HOUR = 19
+
+def in_working_hours(now: datetime.datetime) -> bool:
+    return WORK_START_HOUR <= now.hour <= WORK_END_HOUR
+
+def seconds_until_end_of_working_hours(now: datetime.datetime) -> float:
+    end = now.replace(hour=WORK_END_HOUR, minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+    return max((end - now).total_seconds(), 0)
+
+def handle_completed(pipeline, email_service, sheets_service, notification_service, wait_all=False):
+    """Marks finished emails as read, or reports why they failed."""
+    for msg, error in pipeline.completed(wait_all):
+        if error is None:
+            # 4. Mark as read; the journal forgets the email once the STORE succeeded (see main())
+            email_service.mark_as_read(msg.uid)
+            print(f"Finished processing email: {msg.subject}")
+        else:
+            error_msg = f"Error processing email '{msg.subject}': {str(error)}"
+            print(error_msg)
+            sheets_service.log("ERROR", error_msg, context="Processing Loop")
+            notification_service.send_error_alert(msg.subject, error_msg, context="Processing Email Loop")
+        # The email stays unread after an error; keep its files for the retry in the next cycle
+        email_service.spool.release(msg.uid, keep=error is not None)
+
+def run_cycle(email_service, drive_service, pipeline, sheets_service, notification_service):
+    """
+    Fetches new invoice emails and runs each PDF through Drive upload, extraction and Sheets.
+    An email is marked as read only after all of its PDFs were processed.
+    """
+    # Pick up rows and files added or edited by hand since the last cycle
+    sheets_service.refresh_invoice_index()
+    drive_service.refresh_file_index()
+
+    # One IMAP connection for the whole cycle; \Seen flags are flushed when it closes
+    with email_service.session():
+        email_count = 0
+        try:
+            # Stream emails: each one is handed to the pipeline as soon as its PDFs are on disk
+            for msg, pdf_paths in email_service.iter_invoices():
+                email_count += 1
+                print(f"Processing email: {msg.subject}")
+                sheets_service.log("INFO", f"Processing email: {msg.subject}", context="Email Processing")
+
+                pipeline.submit(msg, pdf_paths)
+                # Handle whatever finished meanwhile; waits here while the pipeline is full
+                handle_completed(pipeline, email_service, sheets_service, notification_service)
+        finally:
+            # Let already submitted emails finish even if fetching failed midway
+            handle_completed(pipeline, email_service, sheets_service, notification_service, wait_all=True)
+            # Write this cycle's buffered Sheets rows before the session closes and flags the remaining emails
+            sheets_service.flush()
+
+        if not email_count:
+            print("No new invoices found.")
+            # sheets_service.log("INFO", "Check completed. No new invoices.", context="Main Loop")
 
 def main():
     load_dotenv()
+    metrics.configure()
     print("Invoice Automation System Started")
-    
+
+    # docker stop sends SIGTERM; exit normally so shutdown hooks flush buffered Sheets rows
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     notification_service = NotificationService()
-    
+
     # Check interval: 1 hour (3600 seconds)
+    # In IDLE mode this is only the safety re-check when no push notification arrives
     check_interval = 3600
-    
+
     try:
         # Initialize services
         email_service = EmailService()
@@ -28,64 +96,52 @@ def main():
         extraction_service = ExtractionService()
         # notion_service = NotionService() # Deprecated
         sheets_service = SheetsService()
-        
+        dedupe_index = DedupeIndex()
+        journal = JobJournal()
+        extraction_cache = ExtractionCache()
+        pipeline = InvoicePipeline(drive_service, extraction_service, sheets_service, dedupe_index, journal, extraction_cache)
+        email_service.on_flagged = journal.flag_emails
+        sheets_service.on_rejected = lambda rejected: notification_service.send_error_alert(
+            "Invoice rows refused by Sheets",
+            f"{len(rejected)} row(s) saved to {sheets_service.rejected_path}: {rejected[0][1]}",
+            context="Sheets Flush"
+        )
+
         print("Services initialized successfully.")
         sheets_service.log("INFO", "System initialized and started.")
-        
+
+        # Push mode: wait in IMAP IDLE between cycles instead of sleeping, if the server supports it
+        use_idle = False
+        if email_service.use_idle:
+            try:
+                use_idle = email_service.supports_idle()
+            except Exception as e:
+                print(f"Could not check IMAP IDLE support: {e}")
+            if not use_idle:
+                print("IMAP IDLE not available, falling back to polling.")
+        # Keep the IMAP connection open between cycles so IDLE does not re-login every time
+        email_service.keep_alive = use_idle
+
         while True:
             try:
                 now = datetime.datetime.now()
-                current_hour = now.hour
-                
+
                 # Run only between 7:00 and 19:00 (inclusive)
-                if 7 <= current_hour <= 19:
+                if in_working_hours(now):
                     print(f"[{now.strftime('%Y-%m-%d %H:%M')}] Checking for new invoices...")
-                    
+
                     try:
-                        emails = email_service.fetch_invoices()
-                        
-                        if not emails:
-                            print("No new invoices found.")
-                            # sheets_service.log("INFO", "Check completed. No new invoices.", context="Main Loop")
-                        else:
-                            for msg, pdf_paths in emails:
-                                print(f"Processing email: {msg.subject}")
-                                sheets_service.log("INFO", f"Processing email: {msg.subject}", context="Email Processing")
-                                
-                                try:
-                                    for pdf_path in pdf_paths:
-                                        print(f"  Processing file: {pdf_path}")
-                                        
-                                        # 1. Upload to Drive
-                                        file_url = drive_service.upload_file(pdf_path)
-                                        if not file_url:
-                                            raise Exception("Failed to upload to Drive")
-                                        
-                                        # 2. Extract Data
-                                        data = extraction_service.extract_data(pdf_path)
-                                        data['file_url'] = file_url
-                                        print(f"    Extracted: {data}")
-                                        
-                                        # 3. Add to Sheets (formerly Notion)
-                                        sheets_service.add_invoice(data)
-                                        
-                                        sheets_service.log("INFO", f"Successfully processed invoice: {data.get('vendor')} - {data.get('amount')}", context="Invoice Success")
-                                        
-                                    # 4. Mark as read
-                                    email_service.mark_as_read(msg.uid)
-                                    print(f"Finished processing email: {msg.subject}")
-                                    
-                                except Exception as e:
-                                    error_msg = f"Error processing email '{msg.subject}': {str(e)}"
-                                    print(error_msg)
-                                    sheets_service.log("ERROR", error_msg, context="Processing Loop")
-                                    notification_service.send_error_alert(msg.subject, error_msg, context="Processing Email Loop")
+                        with metrics.timer("cycle"):
+                            run_cycle(email_service, drive_service, pipeline, sheets_service, notification_service)
                     except Exception as e:
                          # Catch errors during fetch
                         error_msg = f"Error fetching emails: {str(e)}"
                         print(error_msg)
                         sheets_service.log("ERROR", error_msg, context="Fetch Loop")
-                        
+                    finally:
+                        journal.compact()
+                        metrics.end_cycle()
+
                 else:
                     print(f"[{now.strftime('%Y-%m-%d %H:%M')}] Outside working hours (7-19). Sleeping...")
 
@@ -95,9 +151,22 @@ def main():
                 print(error_msg)
                 sheets_service.log("CRITICAL", "Main loop crashed (restarting)", context="Main Loop")
                 notification_service.send_error_alert("Main Loop Error", error_msg, context="Main Loop")
-            
+
             # Wait for next check
-            time.sleep(check_interval)
+            now = datetime.datetime.now()
+            if use_idle and in_working_hours(now):
+                # Wake up on new mail, at the latest after check_interval or when working hours end
+                timeout = min(check_interval, seconds_until_end_of_working_hours(now))
+                try:
+                    if email_service.wait_for_new_mail(timeout):
+                        print("New mail notification received.")
+                except Exception as e:
+                    print(f"IMAP IDLE failed ({e}), falling back to polling.")
+                    use_idle = False
+                    email_service.keep_alive = False
+                    time.sleep(check_interval)
+            else:
+                time.sleep(check_interval)
 
     except Exception as e:
         error_msg = f"Critical System Error: {str(e)}\n{traceback.format_exc()}"
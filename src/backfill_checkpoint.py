@@ -0,0 +1,41 @@
+import os
+import time
+from typing import Set
+from src.dedupe_index import state_dir
+from src.sqlite_store import SqliteStore
+
+
+class BackfillCheckpoint(SqliteStore):
+    """
+    Persistent record of the items a backfill has finished, so an interrupted run resumes
+    where it stopped. Items are grouped by source: an IMAP folder (together with its
+    UIDVALIDITY, as UIDs are only stable while it is unchanged) or a local directory.
+
+    Backfill shards run in separate processes and share one database; SQLite serialises
+    their writes.
+    """
+    schema = (
+        "CREATE TABLE IF NOT EXISTS done ("
+        " source TEXT NOT NULL,"
+        " item TEXT NOT NULL,"
+        " finished_at REAL NOT NULL,"
+        " PRIMARY KEY (source, item))",
+    )
+
+    def __init__(self, path: str = None):
+        # Other shards may hold the write lock for a moment; wait instead of failing
+        super().__init__(
+            path or os.getenv("BACKFILL_CHECKPOINT_PATH", os.path.join(state_dir(), "backfill.sqlite3")),
+            timeout=30,
+        )
+
+    def done_items(self, source: str) -> Set[str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT item FROM done WHERE source = ?", (source,)).fetchall()
+        return {row[0] for row in rows}
+
+    def mark_done(self, source: str, item: str):
+        self._write(
+            "INSERT OR REPLACE INTO done (source, item, finished_at) VALUES (?, ?, ?)",
+            (source, item, time.time())
+        )
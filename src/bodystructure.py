@@ -0,0 +1,248 @@
+import re
+import base64
+import quopri
+from collections import namedtuple
+from email.header import decode_header, make_header
+from typing import Dict, List, Optional
+from urllib.parse import unquote
+
+# One leaf MIME part of a message as described by IMAP BODYSTRUCTURE.
+# section is the IMAP part specifier to use with BODY.PEEK[<section>], size is the encoded size in octets.
+MessagePart = namedtuple(
+    "MessagePart",
+    ["section", "content_type", "params", "encoding", "size", "disposition", "filename"]
+)
+
+_LITERAL_MARKER = re.compile(rb'\{\d+\}$')
+
+# List delimiters are kept as sentinels so a quoted "(" is never mistaken for one
+_OPEN = object()
+_CLOSE = object()
+
+
+class Literal(bytes):
+    """Raw bytes of an IMAP literal ({n} followed by n octets)."""
+
+
+def parse_fetch_response(data: list) -> Dict[str, dict]:
+    """
+    Parses the data list returned by imaplib for a UID FETCH command.
+    Returns a dict keyed by UID, each value a dict of FETCH items
+    (e.g. 'BODYSTRUCTURE', 'BODY[HEADER.FIELDS (SUBJECT FROM DATE)]').
+    """
+    tokens = []
+    for item in data:
+        if isinstance(item, tuple):
+            # (b'... {n}', literal_bytes): the literal follows the prefix
+            prefix, literal = item[0], item[1]
+            tokens.extend(_tokenize(_LITERAL_MARKER.sub(b'', prefix.rstrip())))
+            tokens.append(Literal(literal))
+        elif isinstance(item, bytes):
+            tokens.extend(_tokenize(item))
+
+    messages = {}
+    pos = 0
+    while pos < len(tokens):
+        # "<seq> (<item> <value> ...)"
+        if tokens[pos] is _OPEN:
+            items, pos = _parse_list(tokens, pos + 1)
+        else:
+            pos += 1
+            continue
+        fetched = {}
+        for i in range(0, len(items) - 1, 2):
+            fetched[str(items[i]).upper()] = items[i + 1]
+        if 'UID' in fetched:
+            messages[str(fetched['UID'])] = fetched
+    return messages
+
+
+def _tokenize(raw: bytes) -> list:
+    tokens = []
+    i = 0
+    length = len(raw)
+    while i < length:
+        char = raw[i:i + 1]
+        if char in (b' ', b'\r', b'\n'):
+            i += 1
+        elif char == b'(':
+            tokens.append(_OPEN)
+            i += 1
+        elif char == b')':
+            tokens.append(_CLOSE)
+            i += 1
+        elif char == b'"':
+            # Quoted string with backslash escapes
+            i += 1
+            value = bytearray()
+            while i < length and raw[i:i + 1] != b'"':
+                if raw[i:i + 1] == b'\\':
+                    i += 1
+                value += raw[i:i + 1]
+                i += 1
+            i += 1
+            tokens.append(bytes(value).decode('utf-8', errors='replace'))
+        else:
+            # Atom; section specifiers like BODY[HEADER.FIELDS (SUBJECT)]<0> may contain spaces and parens
+            start = i
+            while i < length and raw[i:i + 1] not in (b' ', b'(', b')', b'\r', b'\n'):
+                if raw[i:i + 1] == b'[':
+                    i = raw.find(b']', i)
+                    if i == -1:
+                        i = length
+                        break
+                i += 1
+            atom = raw[start:i].decode('utf-8', errors='replace')
+            tokens.append(None if atom.upper() == 'NIL' else atom)
+    return tokens
+
+
+def _parse_list(tokens: list, pos: int):
+    """Parses tokens from pos up to the matching ')'. Returns (list, position after it)."""
+    result = []
+    while pos < len(tokens):
+        token = tokens[pos]
+        if token is _OPEN:
+            value, pos = _parse_list(tokens, pos + 1)
+            result.append(value)
+        elif token is _CLOSE:
+            return result, pos + 1
+        else:
+            result.append(token)
+            pos += 1
+    return result, pos
+
+
+def iter_parts(bodystructure: list) -> List[MessagePart]:
+    """Flattens a parsed BODYSTRUCTURE into its leaf parts with IMAP section numbers."""
+    parts = []
+    _walk(bodystructure, "", parts)
+    return parts
+
+
+def _walk(body: list, section: str, parts: list):
+    if not body:
+        return
+
+    if isinstance(body[0], list):
+        # Multipart: leading nested lists are the children, numbered from 1
+        children = []
+        for child in body:
+            if not isinstance(child, list):
+                break
+            children.append(child)
+        for i, child in enumerate(children, 1):
+            _walk(child, f"{section}.{i}" if section else str(i), parts)
+        return
+
+    part_section = section or "1"
+    main_type = _text(body[0]).lower()
+    sub_type = _text(body[1]).lower()
+    params = _pairs(body[2])
+    encoding = _text(body[5]).lower() if len(body) > 5 else ""
+    size = int(body[6]) if len(body) > 6 and str(body[6]).isdigit() else 0
+
+    # Extension data starts after the type-specific fields
+    if main_type == "text":
+        ext = 8
+    elif main_type == "message" and sub_type == "rfc822":
+        ext = 10
+    else:
+        ext = 7
+    disposition, disposition_params = None, {}
+    if len(body) > ext + 1 and isinstance(body[ext + 1], list) and body[ext + 1]:
+        disposition = _text(body[ext + 1][0]).lower()
+        if len(body[ext + 1]) > 1:
+            disposition_params = _pairs(body[ext + 1][1])
+
+    parts.append(MessagePart(
+        section=part_section,
+        content_type=f"{main_type}/{sub_type}",
+        params=params,
+        encoding=encoding,
+        size=size,
+        disposition=disposition,
+        filename=_filename(disposition_params, params),
+    ))
+
+    # Forwarded messages: descend into the embedded message's body
+    if main_type == "message" and sub_type == "rfc822" and len(body) > 8 and isinstance(body[8], list):
+        inner = body[8]
+        if inner and isinstance(inner[0], list):
+            _walk(inner, part_section, parts)
+        else:
+            _walk(inner, f"{part_section}.1", parts)
+
+
+def _text(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return str(value)
+
+
+def _pairs(value) -> Dict[str, str]:
+    """Converts an IMAP parameter list ("key" "value" ...) into a dict with lower-case keys."""
+    if not isinstance(value, list):
+        return {}
+    return {_text(value[i]).lower(): _text(value[i + 1]) for i in range(0, len(value) - 1, 2)}
+
+
+def _filename(disposition_params: Dict[str, str], params: Dict[str, str]) -> Optional[str]:
+    for source, key in ((disposition_params, "filename"), (params, "name")):
+        # RFC 2231: key*=charset''percent-encoded, possibly split into key*0*, key*1*, ...
+        extended = sorted(k for k in source if k.startswith(key + "*"))
+        if extended:
+            value = "".join(source[k] for k in extended)
+            if value.count("'") >= 2:
+                charset, _, encoded = value.split("'", 2)
+                return unquote(encoded, encoding=charset or 'utf-8', errors='replace')
+            return unquote(value)
+        if source.get(key):
+            return _decode_words(source[key])
+    return None
+
+
+def _decode_words(value: str) -> str:
+    """Decodes RFC 2047 encoded words (=?utf-8?b?...?=) in header-ish values."""
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return value
+
+
+class TransferDecoder:
+    """
+    Incrementally decodes a Content-Transfer-Encoding so a part can be fetched in chunks
+    and written out without holding the whole encoded body in memory.
+    """
+
+    def __init__(self, encoding: str):
+        self.encoding = (encoding or "").lower()
+        self._pending = b""
+
+    def decode(self, chunk: bytes) -> bytes:
+        if self.encoding == "base64":
+            # Only whole 4-character groups can be decoded; keep the rest for the next chunk
+            data = self._pending + re.sub(rb'\s+', b'', chunk)
+            usable = len(data) - len(data) % 4
+            self._pending = data[usable:]
+            return base64.b64decode(data[:usable])
+        if self.encoding == "quoted-printable":
+            # Soft line breaks and =XX escapes may straddle chunks; decode whole lines only
+            data = self._pending + chunk
+            cut = data.rfind(b'\n') + 1
+            self._pending = data[cut:]
+            return quopri.decodestring(data[:cut])
+        return chunk
+
+    def flush(self) -> bytes:
+        pending, self._pending = self._pending, b""
+        if not pending:
+            return b""
+        if self.encoding == "base64":
+            return base64.b64decode(pending + b"=" * (-len(pending) % 4))
+        if self.encoding == "quoted-printable":
+            return quopri.decodestring(pending)
+        return pending
@@ -0,0 +1,76 @@
+import os
+import json
+import time
+import hashlib
+from typing import Optional
+from src.sqlite_store import SqliteStore
+
+def state_dir() -> str:
+    """
+    Directory of the persistent state files. Read when a store is created rather than at
+    import time, so a STATE_DIR from the .env file (loaded in main()) takes effect.
+    """
+    return os.getenv("STATE_DIR", "state")
+
+
+def file_sha256(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """SHA-256 of a file's contents, read in chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DedupeIndex(SqliteStore):
+    """
+    Persistent index of PDFs that went through the whole pipeline, keyed by the SHA-256
+    of their bytes. Stores the Drive webViewLink and the extracted fields so a resent
+    or retried PDF can be recognised without uploading or parsing it again.
+
+    The index is bounded: entries older than max_age_days and the oldest entries beyond
+    max_entries are evicted.
+    """
+    schema = (
+        "CREATE TABLE IF NOT EXISTS documents ("
+        " sha256 TEXT PRIMARY KEY,"
+        " file_url TEXT,"
+        " data TEXT,"
+        " created_at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS documents_created_at ON documents (created_at)",
+    )
+
+    def __init__(self, path: str = None):
+        self.max_entries = int(os.getenv("DEDUPE_MAX_ENTRIES", 50000))
+        self.max_age_days = float(os.getenv("DEDUPE_MAX_AGE_DAYS", 365))
+        # Shared by the pipeline's worker threads
+        super().__init__(path or os.getenv("DEDUPE_INDEX_PATH", os.path.join(state_dir(), "dedupe.sqlite3")))
+
+    def lookup(self, sha256: str) -> Optional[dict]:
+        """Returns {'file_url': ..., 'data': {...}} for a known document, None otherwise."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file_url, data, created_at FROM documents WHERE sha256 = ?", (sha256,)
+            ).fetchone()
+        if row is None or row[2] < time.time() - self.max_age_days * 86400:
+            return None
+        return {"file_url": row[0], "data": json.loads(row[1] or "{}")}
+
+    def record(self, sha256: str, file_url: str, data: dict):
+        self._write(
+            "INSERT OR REPLACE INTO documents (sha256, file_url, data, created_at) VALUES (?, ?, ?, ?)",
+            (sha256, file_url, json.dumps(data, ensure_ascii=False, default=str), time.time())
+        )
+
+    def evict(self):
+        """Drops entries past max_age_days, then the oldest ones above max_entries."""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM documents WHERE created_at < ?", (time.time() - self.max_age_days * 86400,)
+            )
+            self._conn.execute(
+                "DELETE FROM documents WHERE sha256 IN ("
+                " SELECT sha256 FROM documents ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
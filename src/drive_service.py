@@ -1,92 +1,235 @@
 import os
 import json
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+import time
+import random
+import hashlib
+import httplib2
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaFileUpload
+from src import metrics
+from src.dedupe_index import state_dir
+from src.google_clients import RETRYABLE_STATUSES, build_service
+
+
+def file_md5(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """MD5 of a file's contents, as Drive reports it in md5Checksum."""
+    digest = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-class DriveService:
-    SCOPES = ['https://www.googleapis.com/auth/drive']
 
+class DriveService:
     def __init__(self):
-        self.service_account_info = os.getenv("GOOGLE_SERVICE_ACCOUNT_FILE")
-        self.service_account_json = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
         self.folder_id = os.getenv("GOOGLE_DRIVE_FOLDER_ID")
         
         if not self.folder_id:
             raise ValueError("GOOGLE_DRIVE_FOLDER_ID environment variable not set.")
 
+        # Typical invoices are far below the threshold and need only one request
+        self.resumable_threshold = int(os.getenv("DRIVE_RESUMABLE_THRESHOLD", 5 * 1024 * 1024))
+        # Resumable chunks must be a multiple of 256 KiB
+        self.chunk_size = int(os.getenv("DRIVE_CHUNK_SIZE", 8 * 1024 * 1024))
+        self.max_retries = int(os.getenv("DRIVE_MAX_RETRIES", 5))
+        self.upload_workers = int(os.getenv("DRIVE_UPLOAD_WORKERS", 4))
+
         try:
-            self.creds = None
-            
-            # 1. Try GOOGLE_SERVICE_ACCOUNT_JSON (Priority)
-            if self.service_account_json:
-                try:
-                    info = json.loads(self.service_account_json)
-                    self.creds = service_account.Credentials.from_service_account_info(
-                        info, scopes=self.SCOPES
-                    )
-                    print("DEBUG: Authenticated using GOOGLE_SERVICE_ACCOUNT_JSON")
-                except json.JSONDecodeError as e:
-                    print(f"Warning: GOOGLE_SERVICE_ACCOUNT_JSON is invalid JSON: {e}")
-
-            # 2. Try GOOGLE_SERVICE_ACCOUNT_FILE (Fallback)
-            if not self.creds and self.service_account_info:
-                # First, try to treat it as a file path
-                if os.path.exists(self.service_account_info):
-                    self.creds = service_account.Credentials.from_service_account_file(
-                        self.service_account_info, scopes=self.SCOPES
-                    )
-                    print("DEBUG: Authenticated using GOOGLE_SERVICE_ACCOUNT_FILE (path)")
-                else:
-                    # If file doesn't exist, try to parse the variable content as JSON
-                    try:
-                        # Clean the string: remove whitespace and potential surrounding quotes
-                        clean_info = self.service_account_info.strip().strip("'").strip('"')
-                        
-                        # Debug: Print info about the string (safe version)
-                        print(f"DEBUG: Service Account Info Length: {len(clean_info)}")
-                        if len(clean_info) < 20:
-                             print(f"DEBUG: Starts with: {clean_info}...")
-                        
-                        info = json.loads(clean_info)
-                        self.creds = service_account.Credentials.from_service_account_info(
-                            info, scopes=self.SCOPES
-                        )
-                        print("DEBUG: Authenticated using GOOGLE_SERVICE_ACCOUNT_FILE (content)")
-                    except json.JSONDecodeError as e:
-                         print(f"JSON Decode Error in FILE variable: {e}")
-
-            if not self.creds:
-                 raise ValueError("Could not authenticate. Neither GOOGLE_SERVICE_ACCOUNT_JSON nor GOOGLE_SERVICE_ACCOUNT_FILE provided valid credentials.")
-
-            self.service = build('drive', 'v3', credentials=self.creds)
+            # Credentials, transport and discovery are shared with SheetsService
+            self.service = build_service('drive', 'v3')
         except Exception as e:
             raise ValueError(f"Failed to authenticate with Google Drive: {e}")
 
+        self._init_file_index()
+
+    def _init_file_index(self):
+        """
+        Index of md5Checksum -> webViewLink for the files in the target folder, so identical
+        PDFs are not uploaded twice. Built once with a paginated files.list, then kept up to
+        date with the changes API from a page token persisted in index_path (restarts resume
+        from the token instead of listing the folder again).
+        """
+        self.index_path = os.getenv("DRIVE_INDEX_PATH", os.path.join(state_dir(), "drive_index.json"))
+        self._index_lock = threading.Lock()
+        # file id -> [md5Checksum, webViewLink]; id-keyed so removals from the changes feed can be applied
+        self._files = {}
+        self._by_md5 = {}
+        self._page_token = None
+
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("folder_id") == self.folder_id:
+                self._files = state.get("files", {})
+                self._page_token = state.get("page_token")
+        except (OSError, ValueError):
+            pass
+
+        self.refresh_file_index()
+
+    def refresh_file_index(self):
+        """Applies the Drive changes since the last refresh (call once per cycle)."""
+        try:
+            with metrics.timer("drive_index"):
+                if self._page_token is None:
+                    self._list_folder()
+                else:
+                    self._apply_changes()
+        except Exception as e:
+            # Without an index every file is simply uploaded; the next refresh lists the folder again
+            print(f"Failed to refresh Drive file index: {e}")
+            self._page_token = None
+            return
+
+        with self._index_lock:
+            self._by_md5 = {md5: link for md5, link in self._files.values() if md5}
+        self._save_file_index()
+
+    def _list_folder(self):
+        # Take the token first so changes made during the listing are replayed, not lost
+        page_token = self.service.changes().getStartPageToken(supportsAllDrives=True).execute()['startPageToken']
+        files = {}
+        request = self.service.files().list(
+            q=f"'{self.folder_id}' in parents and trashed = false",
+            fields="nextPageToken, files(id, md5Checksum, webViewLink)",
+            pageSize=1000,
+            supportsAllDrives=True,
+            includeItemsFromAllDrives=True,
+        )
+        while request is not None:
+            response = request.execute()
+            for file in response.get('files', []):
+                files[file['id']] = [file.get('md5Checksum'), file.get('webViewLink')]
+            request = self.service.files().list_next(request, response)
+
+        with self._index_lock:
+            self._files = files
+            self._page_token = page_token
+        print(f"Drive file index built: {len(files)} file(s) in the target folder.")
+
+    def _apply_changes(self):
+        page_token = self._page_token
+        while True:
+            response = self.service.changes().list(
+                pageToken=page_token,
+                fields="nextPageToken, newStartPageToken, changes(changeType, fileId, removed, file(md5Checksum, webViewLink, parents, trashed))",
+                pageSize=1000,
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True,
+            ).execute()
+
+            with self._index_lock:
+                for change in response.get('changes', []):
+                    # Shared drive changes (changeType "drive") carry a driveId instead of a fileId
+                    if change.get('changeType', 'file') != 'file' or 'fileId' not in change:
+                        continue
+                    file = change.get('file') or {}
+                    if change.get('removed') or file.get('trashed') or self.folder_id not in file.get('parents', []):
+                        self._files.pop(change['fileId'], None)
+                    else:
+                        self._files[change['fileId']] = [file.get('md5Checksum'), file.get('webViewLink')]
+
+            if 'newStartPageToken' in response:
+                with self._index_lock:
+                    self._page_token = response['newStartPageToken']
+                return
+            page_token = response['nextPageToken']
+
+    def _save_file_index(self):
+        with self._index_lock:
+            state = {"folder_id": self.folder_id, "page_token": self._page_token, "files": dict(self._files)}
+
+        directory = os.path.dirname(self.index_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.index_path)
+
     def upload_file(self, file_path: str) -> str:
         """
         Uploads a file to the configured Google Drive folder.
-        Returns the webViewLink of the uploaded file.
+        Returns the webViewLink of the uploaded file, or of the identical file already in the folder.
+        Files below resumable_threshold go up in a single multipart request; larger ones
+        use a resumable upload sent in chunk_size chunks. Quota and server errors are
+        retried with exponential backoff; the last error is raised.
         """
+        md5 = file_md5(file_path)
+        with self._index_lock:
+            existing = self._by_md5.get(md5)
+        if existing:
+            print(f"File already on Drive, upload skipped: {file_path} ({existing})")
+            metrics.inc("invoice_documents_total", stage="drive_upload_skipped")
+            return existing
+
         file_name = os.path.basename(file_path)
         
         file_metadata = {
             'name': file_name,
             'parents': [self.folder_id]
         }
-        
-        media = MediaFileUpload(file_path, resumable=True)
-        
-        try:
-            file = self.service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id, webViewLink'
-            ).execute()
-            
-            print(f"File uploaded: {file.get('name')} (ID: {file.get('id')})")
-            return file.get('webViewLink')
-            
-        except Exception as e:
-            print(f"Error uploading file to Drive: {e}")
-            return None
+
+        resumable = os.path.getsize(file_path) >= self.resumable_threshold
+        if resumable:
+            media = MediaFileUpload(file_path, chunksize=self.chunk_size, resumable=True)
+        else:
+            media = MediaFileUpload(file_path, resumable=False)
+
+        request = self.service.files().create(
+            body=file_metadata,
+            media_body=media,
+            fields='id, name, md5Checksum, webViewLink'
+        )
+
+        file = None
+        attempt = 0
+        while file is None:
+            try:
+                with metrics.timer("drive_upload"):
+                    if resumable:
+                        # A retried chunk resumes where the upload stopped
+                        _, file = request.next_chunk()
+                        attempt = 0
+                    else:
+                        file = request.execute()
+            except Exception as e:
+                if not self._is_retryable(e) or attempt >= self.max_retries:
+                    print(f"Error uploading file to Drive: {e}")
+                    metrics.inc("invoice_api_errors_total", api="drive")
+                    raise
+                metrics.inc("invoice_api_retries_total", api="drive")
+                # Exponential backoff with jitter, capped at one minute
+                time.sleep(min(2 ** attempt, 60) * random.uniform(0.5, 1.5))
+                attempt += 1
+
+        print(f"File uploaded: {file.get('name')} (ID: {file.get('id')})")
+        metrics.inc("invoice_documents_total", stage="drive_upload")
+        with self._index_lock:
+            self._files[file['id']] = [file.get('md5Checksum') or md5, file.get('webViewLink')]
+            self._by_md5[md5] = file.get('webViewLink')
+        return file.get('webViewLink')
+
+    def upload_files(self, file_paths: List[str]) -> Dict[str, Optional[str]]:
+        """
+        Uploads several files concurrently (upload_workers threads over the shared transport).
+        Returns {path: webViewLink}; the link is None for files that failed to upload.
+        """
+        links = {}
+        with ThreadPoolExecutor(max_workers=self.upload_workers, thread_name_prefix="drive-upload") as pool:
+            futures = {path: pool.submit(self.upload_file, path) for path in file_paths}
+            for path, future in futures.items():
+                try:
+                    links[path] = future.result()
+                except Exception:
+                    links[path] = None
+        return links
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        if isinstance(error, HttpError):
+            return error.resp.status in RETRYABLE_STATUSES
+        return isinstance(error, (OSError, httplib2.HttpLib2Error))
@@ -1,12 +1,38 @@
 import os
-import requests
-from imap_tools import MailBox, AND
-from typing import List, Optional, Tuple
+import time
+import datetime
+import imaplib
+from collections import namedtuple
+from concurrent.futures import Future
+from contextlib import contextmanager
+from email.parser import BytesHeaderParser
+from email.policy import default as default_policy
+from email.utils import parseaddr, parsedate_to_datetime
+from imap_tools import MailBox, MailBoxUnencrypted, AND, OR, MailMessageFlags
+from typing import Iterator, List, Optional, Tuple
 from bs4 import BeautifulSoup
-import re
+from src import metrics
+from src.link_downloader import LinkDownloader
+from src.spool import Spool
+from src.bodystructure import MessagePart, TransferDecoder, iter_parts, parse_fetch_response
+
+# Header-only view of an invoice email. Only the fields the pipeline needs are kept;
+# the message body is never downloaded as a whole.
+InvoiceEmail = namedtuple("InvoiceEmail", ["uid", "subject", "from_", "date"])
+
+# Errors that mean the IMAP connection itself is gone (as opposed to a rejected command)
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, OSError, EOFError)
+
+def _exists_count(mailbox) -> Optional[int]:
+    """Latest message count the server announced for the selected folder (imaplib keeps every untagged EXISTS)."""
+    counts = mailbox.client.untagged_responses.get("EXISTS")
+    try:
+        return int(counts[-1]) if counts else None
+    except ValueError:
+        return None
 
 class EmailService:
-    def __init__(self):
+    def __init__(self, spool: Spool = None):
         self.host = os.getenv("EMAIL_HOST")
         self.user = os.getenv("EMAIL_USER")
         self.password = os.getenv("EMAIL_PASSWORD")
@@ -14,68 +40,322 @@ class EmailService:
         if not all([self.host, self.user, self.password]):
             raise ValueError("Email credentials not found in environment variables.")
 
-    def fetch_invoices(self, folder="INBOX") -> List[Tuple[object, List[str]]]:
+        self.port = int(os.getenv("EMAIL_IMAP_PORT", 993))
+        # Plain-text IMAP is only meant for local test servers such as the benchmark's
+        self.use_ssl = os.getenv("EMAIL_IMAP_SSL", "true").lower() in ("1", "true", "yes")
+
+        # Number of UIDs flagged \Seen per STORE command
+        self.seen_batch_size = int(os.getenv("EMAIL_SEEN_BATCH_SIZE", 50))
+        # How many times a dropped connection is re-established within one operation
+        self.max_reconnects = int(os.getenv("EMAIL_MAX_RECONNECTS", 3))
+        # Push mode: wait for new mail with IMAP IDLE instead of sleeping between polls
+        self.use_idle = os.getenv("EMAIL_USE_IDLE", "true").lower() in ("1", "true", "yes")
+        # Re-issue IDLE before the server drops it (RFC 2177 allows servers to end it after 29 minutes)
+        self.idle_refresh = int(os.getenv("EMAIL_IDLE_REFRESH", 25 * 60))
+        # Messages whose headers and BODYSTRUCTURE are fetched per FETCH command
+        self.header_batch_size = int(os.getenv("EMAIL_HEADER_BATCH_SIZE", 100))
+        # Bytes of an encoded MIME part requested per partial FETCH
+        self.part_chunk_size = int(os.getenv("EMAIL_PART_CHUNK_SIZE", 1024 * 1024))
+        # Keep the connection open after a session ends (used between IDLE waits)
+        self.keep_alive = False
+        # Called with the UIDs of every STORE \Seen that succeeded (e.g. JobJournal.flag_emails)
+        self.on_flagged = None
+
+        self._mailbox = None
+        self._folder = None
+        self._session_depth = 0
+        self._pending_seen = {}
+        # Message count of each folder right after its last search, to notice mail that arrives during a cycle
+        self._searched_exists = {}
+        # Per-message download directories, removed once the email is processed
+        self.spool = spool or Spool()
+        # Pooled HTTP downloads of invoices that arrive as links instead of attachments
+        self.link_downloader = LinkDownloader(self.spool)
+
+    @contextmanager
+    def session(self):
+        """
+        Keeps one authenticated IMAP connection open for the duration of the block
+        (typically one polling cycle). Pending \\Seen flags are flushed and the
+        connection is logged out when the block exits.
+        """
+        self._session_depth += 1
+        try:
+            yield self
+        finally:
+            self._session_depth -= 1
+            if not self._session_depth:
+                try:
+                    self.flush_seen()
+                finally:
+                    if not self.keep_alive:
+                        self._disconnect()
+
+    def _get_mailbox(self, folder: str) -> MailBox:
+        """Returns the session mailbox, logging in and selecting the folder if needed."""
+        if self._mailbox is None:
+            mailbox_class = MailBox if self.use_ssl else MailBoxUnencrypted
+            self._mailbox = mailbox_class(self.host, self.port).login(self.user, self.password)
+            self._folder = None
+        if self._folder != folder:
+            self._mailbox.folder.set(folder)
+            self._folder = folder
+        return self._mailbox
+
+    def _disconnect(self):
+        mailbox, self._mailbox, self._folder = self._mailbox, None, None
+        if mailbox is None:
+            return
+        try:
+            mailbox.logout()
+        except Exception:
+            # The connection may already be dead; nothing left to clean up
+            pass
+
+    def _run(self, operation, folder: str):
+        """
+        Runs operation(mailbox) on the session connection.
+        Reconnects and retries when the connection has dropped.
+        """
+        attempt = 0
+        while True:
+            try:
+                return operation(self._get_mailbox(folder))
+            except CONNECTION_ERRORS as e:
+                self._disconnect()
+                attempt += 1
+                if attempt > self.max_reconnects:
+                    raise
+                print(f"IMAP connection lost ({e}), reconnecting (attempt {attempt})...")
+
+    def fetch_invoices(self, folder="INBOX") -> List[Tuple[InvoiceEmail, List[str]]]:
         """
         Fetches unread emails containing 'invoice' or 'számla' in subject or body.
         Returns a list of tuples: (email_object, list_of_pdf_paths)
         """
-        processed_emails = []
+        return list(self.iter_invoices(folder))
+
+    def search_invoices(self, folder="INBOX", since: datetime.date = None, until: datetime.date = None,
+                        unseen_only: bool = True) -> List[str]:
+        """
+        UIDs of the invoice emails in a folder: subject keywords, optionally limited to
+        unread emails and to a date range (since inclusive, until exclusive).
+        """
+        criteria = {}
+        if unseen_only:
+            criteria["seen"] = False
+        if since:
+            criteria["date_gte"] = since
+        if until:
+            criteria["date_lt"] = until
+
+        # Any of the keywords (a list in AND would require all of them); the accented ones need UTF-8
+        keywords = OR(subject=["invoice", "számla", "díjbekérő"])
+
+        def search(mailbox):
+            uids = mailbox.uids(AND(keywords, **criteria), charset="utf-8")
+            self._searched_exists[folder] = _exists_count(mailbox)
+            return uids
+
+        with metrics.timer("imap_search"):
+            return self._run(search, folder)
+
+    def folder_uidvalidity(self, folder: str) -> str:
+        """UIDVALIDITY of a folder; UIDs saved earlier are only meaningful while it is unchanged."""
+        status = self._run(lambda mailbox: mailbox.folder.status(folder, ["UIDVALIDITY"]), folder)
+        return str(status.get("UIDVALIDITY", ""))
+
+    def iter_invoices(self, folder="INBOX", uids: List[str] = None) -> Iterator[Tuple[InvoiceEmail, List[str]]]:
+        """
+        Streaming variant of fetch_invoices.
+        Yields (email_object, list_of_pdf_paths) as soon as each message's PDFs are on disk,
+        so processing can start while later messages are still being fetched.
         
+        Fetching is two-phase: headers and BODYSTRUCTURE are pulled in bulk first, then only
+        the PDF parts (or the HTML part, when falling back to links) are downloaded, in
+        chunks, straight to disk.
+        Without uids, the unread invoice emails of the folder are fetched.
+        """
         try:
-            with MailBox(self.host).login(self.user, self.password) as mailbox:
-                mailbox.folder.set(folder)
-                
+            # Files kept from an earlier attempt are only reused for the same folder and UIDVALIDITY
+            self.spool.bind(f"{self.user}@{self.host}/{folder}/{self.folder_uidvalidity(folder)}")
+            if uids is None:
                 # Search for unread emails with keywords
-                criteria = AND(seen=False, subject=["invoice", "számla", "díjbekérő"])
+                uids = self.search_invoices(folder)
+            
+            # Emails whose PDF is behind a link; their downloads run while fetching continues
+            pending_links = []
+            
+            for i in range(0, len(uids), self.header_batch_size):
+                batch = uids[i:i + self.header_batch_size]
+                structures = self._fetch_structures(batch, folder)
                 
-                for msg in mailbox.fetch(criteria, mark_seen=False):
-                    print(f"Processing email: {msg.subject}")
-                    pdf_files = self._download_attachments(msg)
-                    
-                    if not pdf_files:
-                        print(f"No PDF attachments found in: {msg.subject}. Checking for links...")
-                        pdf_files = self._download_from_links(msg)
+                for uid in batch:
+                    fetched = structures.get(uid)
+                    if not fetched:
+                        continue
                     
+                    email, pdf_files, link_download = self._save_invoice_files(uid, fetched, folder)
                     if pdf_files:
-                        processed_emails.append((msg, pdf_files))
-                    else:
-                        print(f"No PDF found (attachment or link) in: {msg.subject}")
+                        yield email, pdf_files
+                    elif link_download:
+                        pending_links.append((email, link_download))
+                    yield from self._finished_link_downloads(pending_links)
+                    
+            yield from self._finished_link_downloads(pending_links, wait=True)
                         
         except Exception as e:
             print(f"Error fetching emails: {e}")
             raise e # Re-raise to be caught by main loop
+        finally:
+            if not self._session_depth and not self.keep_alive:
+                self._disconnect()
+
+    def _fetch_structures(self, uids: List[str], folder: str) -> dict:
+        """Phase 1: fetches the headers we need and the BODYSTRUCTURE of several messages at once."""
+        def fetch(mailbox):
+            typ, data = mailbox.client.uid(
+                'FETCH', ','.join(uids), '(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)])'
+            )
+            if typ != 'OK':
+                raise imaplib.IMAP4.error(f"FETCH BODYSTRUCTURE failed: {data}")
+            return parse_fetch_response(data)
+
+        with metrics.timer("imap_headers"):
+            return self._run(fetch, folder)
+
+    def _save_invoice_files(self, uid: str, fetched: dict, folder: str) -> Tuple[InvoiceEmail, List[str], Optional[Future]]:
+        """
+        Phase 2: writes the PDF attachments of a message to disk. Without attachments, the
+        invoice links of the HTML body are handed to the link downloader instead.
+        Returns the header-only email object, the list of saved paths and the link download
+        (a Future of the downloaded path), if one was started.
+        """
+        email = self._parse_headers(uid, fetched)
+        parts = iter_parts(fetched.get('BODYSTRUCTURE') or [])
+        
+        print(f"Processing email: {email.subject}")
+        pdf_files = self._download_attachments(uid, parts, folder)
+        if pdf_files:
+            return email, pdf_files, None
+        
+        print(f"No PDF attachments found in: {email.subject}. Checking for links...")
+        urls = self._find_invoice_links(self._fetch_html(uid, parts, folder))
+        if not urls:
+            print(f"No PDF found (attachment or link) in: {email.subject}")
+            self.spool.release(uid)
+            return email, [], None
+            
+        return email, [], self.link_downloader.submit(urls, uid)
+
+    def _finished_link_downloads(self, pending: list, wait: bool = False) -> Iterator[Tuple[InvoiceEmail, List[str]]]:
+        """Yields (email, [path]) for the link downloads that are done (all of them with wait=True)."""
+        for item in list(pending):
+            email, download = item
+            if not wait and not download.done():
+                continue
+            pending.remove(item)
+            
+            filepath = download.result()
+            if filepath:
+                yield email, [filepath]
+            else:
+                print(f"No PDF found (attachment or link) in: {email.subject}")
+                self.spool.release(email.uid)
+
+    def _parse_headers(self, uid: str, fetched: dict) -> InvoiceEmail:
+        raw_headers = b""
+        for key, value in fetched.items():
+            if key.startswith('BODY[HEADER') and isinstance(value, bytes):
+                raw_headers = value
+                
+        headers = BytesHeaderParser(policy=default_policy).parsebytes(raw_headers)
+        try:
+            date = parsedate_to_datetime(str(headers['date'])) if headers['date'] else None
+        except (TypeError, ValueError):
+            date = None
             
-        return processed_emails
+        return InvoiceEmail(
+            uid=uid,
+            subject=str(headers['subject'] or ''),
+            from_=parseaddr(str(headers['from'] or ''))[1],
+            date=date,
+        )
 
-    def _download_attachments(self, msg) -> List[str]:
+    def _iter_part(self, uid: str, part: MessagePart, folder: str) -> Iterator[bytes]:
+        """Yields the decoded content of one MIME part, fetched part_chunk_size encoded bytes at a time."""
+        decoder = TransferDecoder(part.encoding)
+        offset = 0
+        
+        while True:
+            with metrics.timer("imap_fetch"):
+                chunk = self._run(lambda mailbox: self._fetch_part_chunk(mailbox, uid, part.section, offset), folder)
+            metrics.inc("invoice_bytes_fetched_total", len(chunk), source="imap")
+            offset += len(chunk)
+            yield decoder.decode(chunk)
+            if len(chunk) < self.part_chunk_size:
+                break
+                
+        yield decoder.flush()
+
+    def _fetch_part_chunk(self, mailbox, uid: str, section: str, offset: int) -> bytes:
+        typ, data = mailbox.client.uid(
+            'FETCH', uid, f'(BODY.PEEK[{section}]<{offset}.{self.part_chunk_size}>)'
+        )
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"FETCH BODY[{section}] failed: {data}")
+        for item in data:
+            if isinstance(item, tuple):
+                return item[1]
+        # Empty or NIL section
+        return b""
+
+    def _download_attachments(self, uid: str, parts: List[MessagePart], folder: str) -> List[str]:
         """
-        Downloads PDF attachments from the email message.
+        Downloads PDF attachments from the email message into its spool directory.
         Returns a list of local file paths.
+        Attachments kept from a failed earlier attempt are reused instead of being fetched again.
         """
         saved_files = []
-        download_folder = "downloads"
-        os.makedirs(download_folder, exist_ok=True)
-
-        for att in msg.attachments:
-            if att.filename.lower().endswith(".pdf"):
-                filepath = os.path.join(download_folder, att.filename)
-                with open(filepath, "wb") as f:
-                    f.write(att.payload)
-                saved_files.append(filepath)
+
+        for part in parts:
+            is_pdf = (part.filename or "").lower().endswith(".pdf") or part.content_type == "application/pdf"
+            if not is_pdf:
+                continue
+                
+            filename = os.path.basename((part.filename or "").replace("\\", "/")) or f"attachment_{uid}_{part.section}.pdf"
+            if any(os.path.basename(path) == filename for path in saved_files):
+                # Same name twice in one email; the section number keeps it deterministic across retries
+                filename = f"{part.section}_{filename}"
+
+            filepath = self.spool.find(uid, filename)
+            if filepath:
+                print(f"Reusing attachment from an earlier attempt: {filepath}")
+            else:
+                # The encoded size is an upper bound of the decoded one
+                filepath = self.spool.write(uid, filename, self._iter_part(uid, part, folder), size_hint=part.size)
                 print(f"Downloaded attachment: {filepath}")
+            saved_files.append(filepath)
                 
         return saved_files
 
-    def _download_from_links(self, msg) -> List[str]:
+    def _fetch_html(self, uid: str, parts: List[MessagePart], folder: str) -> Optional[str]:
+        """Fetches only the HTML body part of the message, if it has one."""
+        for part in parts:
+            if part.content_type == "text/html" and part.disposition != "attachment":
+                body = b"".join(self._iter_part(uid, part, folder))
+                charset = part.params.get("charset") or "utf-8"
+                try:
+                    return body.decode(charset, errors="replace")
+                except LookupError:
+                    return body.decode("utf-8", errors="replace")
+        return None
+
+    def _find_invoice_links(self, html_body: Optional[str]) -> List[str]:
         """
-        Parses email body for download links and downloads the PDF.
-        Returns a list of local file paths.
+        Parses email body for download links.
+        Returns the candidate URLs, in document order.
         """
-        saved_files = []
-        download_folder = "downloads"
-        os.makedirs(download_folder, exist_ok=True)
-        
-        html_body = msg.html
         if not html_body:
             return []
 
@@ -85,67 +365,82 @@ class EmailService:
         # Keywords to look for in link text or class/id
         keywords = ["számla letöltése", "számla megtekintése", "download invoice", "számla"]
         
+        urls = []
         for link in links:
             text = link.get_text().lower().strip()
             href = link['href']
             
             # Check if link text matches keywords
-            if any(kw in text for kw in keywords):
+            if any(kw in text for kw in keywords) and href.startswith(("http://", "https://")):
                 print(f"Found potential invoice link: {href}")
+                urls.append(href)
+
+        return urls
+
+    def mark_as_read(self, msg_uid, folder="INBOX"):
+        """
+        Marks an email as read.
+        Inside a session the UID is queued and flagged together with others in one
+        STORE command once seen_batch_size UIDs are pending (or when the session ends).
+        """
+        self._pending_seen.setdefault(folder, []).append(msg_uid)
+        
+        if not self._session_depth or len(self._pending_seen[folder]) >= self.seen_batch_size:
+            self.flush_seen(folder)
+            if not self._session_depth and not self.keep_alive:
+                self._disconnect()
+
+    def flush_seen(self, folder=None):
+        """Flags all queued UIDs as \\Seen, batching seen_batch_size UIDs per STORE."""
+        folders = [folder] if folder else list(self._pending_seen)
+        
+        for name in folders:
+            uids = self._pending_seen.pop(name, [])
+            for i in range(0, len(uids), self.seen_batch_size):
+                batch = uids[i:i + self.seen_batch_size]
                 try:
-                    filepath = self._download_file_from_url(href, download_folder)
-                    if filepath:
-                        saved_files.append(filepath)
-                        # Assume one invoice per email usually, but let's keep looking just in case? 
-                        # Usually one main CTA is enough.
-                        break 
+                    self._run(lambda mailbox: mailbox.flag(batch, MailMessageFlags.SEEN, True), name)
                 except Exception as e:
-                    print(f"Failed to download from link {href}: {e}")
+                    print(f"Error marking emails as read ({', '.join(batch)}): {e}")
+                    continue
+                if self.on_flagged:
+                    self.on_flagged(batch)
 
-        return saved_files
+    def _arrived_since_search(self, mailbox, folder: str) -> bool:
+        searched = self._searched_exists.get(folder)
+        if searched is None:
+            return False
+        # NOOP collects announcements still in flight; the count is compared with the one at search time
+        mailbox.client.noop()
+        current = _exists_count(mailbox)
+        return current is not None and current > searched
 
-    def _download_file_from_url(self, url: str, folder: str) -> Optional[str]:
-        try:
-            response = requests.get(url, allow_redirects=True)
-            response.raise_for_status()
-            
-            # Try to get filename from headers
-            content_disposition = response.headers.get('content-disposition')
-            filename = None
-            if content_disposition:
-                fname = re.findall("filename=(.+)", content_disposition)
-                if fname:
-                    filename = fname[0].strip('"')
-            
-            if not filename:
-                # Fallback: generate a name based on timestamp
-                import time
-                filename = f"invoice_download_{int(time.time())}.pdf"
-                
-            if not filename.lower().endswith('.pdf'):
-                # Sometimes the link is a viewer, not direct PDF. 
-                # If content-type is not pdf, we might be in trouble.
-                if 'application/pdf' not in response.headers.get('Content-Type', ''):
-                    print(f"URL did not return a PDF: {url}")
-                    return None
-                filename += ".pdf"
-
-            filepath = os.path.join(folder, filename)
-            with open(filepath, 'wb') as f:
-                f.write(response.content)
+    def supports_idle(self, folder="INBOX") -> bool:
+        """Checks whether the IMAP server advertises the IDLE capability."""
+        capabilities = self._run(lambda mailbox: mailbox.client.capabilities, folder)
+        return 'IDLE' in capabilities
+
+    def wait_for_new_mail(self, timeout: float, folder="INBOX") -> bool:
+        """
+        Blocks in IMAP IDLE until the server announces new mail or timeout seconds pass.
+        IDLE is re-issued every idle_refresh seconds so the server never times it out.
+        Returns True if new mail arrived, False on timeout.
+        Mail that arrived after the last search returns True right away: the server announced
+        it in the responses to later commands (FETCH, STORE), which IDLE does not see again.
+        """
+        if self._run(lambda mailbox: self._arrived_since_search(mailbox, folder), folder):
+            return True
+
+        deadline = time.monotonic() + timeout
+        
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
             
-            print(f"Downloaded from URL: {filepath}")
-            return filepath
+            wait = min(remaining, self.idle_refresh)
+            responses = self._run(lambda mailbox: mailbox.idle.wait(timeout=wait), folder)
             
-        except Exception as e:
-            print(f"Error downloading from URL {url}: {e}")
-            return None
-
-    def mark_as_read(self, msg_uid, folder="INBOX"):
-        """Marks an email as read."""
-        try:
-            with MailBox(self.host).login(self.user, self.password) as mailbox:
-                mailbox.folder.set(folder)
-                mailbox.flag([msg_uid], '\\Seen', True)
-        except Exception as e:
-            print(f"Error marking email as read: {e}")
+            # "* <n> EXISTS" is sent when a message is added to the selected folder
+            if any(b'EXISTS' in response for response in responses):
+                return True
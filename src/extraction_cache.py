@@ -0,0 +1,61 @@
+import os
+import json
+import time
+from typing import Optional
+from src.dedupe_index import state_dir
+from src.sqlite_store import SqliteStore
+
+
+class ExtractionCache(SqliteStore):
+    """
+    Persistent memo of ExtractionService results, keyed by the SHA-256 of the PDF.
+
+    Every entry records the extractor version that produced it (see
+    ExtractionService.cache_version). An entry written by another version is a miss and
+    is overwritten by the next store, so bumping the version invalidates entries lazily,
+    one document at a time, without flushing the cache.
+
+    The cache is an LRU: hits refresh an entry, and the least recently used entries
+    beyond max_entries are evicted.
+    """
+    schema = (
+        "CREATE TABLE IF NOT EXISTS results ("
+        " sha256 TEXT PRIMARY KEY,"
+        " version TEXT NOT NULL,"
+        " data TEXT NOT NULL,"
+        " used_at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS results_used_at ON results (used_at)",
+    )
+
+    def __init__(self, path: str = None):
+        self.max_entries = int(os.getenv("EXTRACTION_CACHE_MAX_ENTRIES", 20000))
+        # Shared by the executor's dispatcher threads
+        super().__init__(path or os.getenv("EXTRACTION_CACHE_PATH", os.path.join(state_dir(), "extraction_cache.sqlite3")))
+
+    def lookup(self, sha256: str, version: str) -> Optional[dict]:
+        """The cached extraction of a document, if it was made by this version."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT version, data FROM results WHERE sha256 = ?", (sha256,)
+            ).fetchone()
+            if row is None or row[0] != version:
+                return None
+            self._conn.execute("UPDATE results SET used_at = ? WHERE sha256 = ?", (time.time(), sha256))
+            self._conn.commit()
+        return json.loads(row[1])
+
+    def store(self, sha256: str, version: str, data: dict):
+        self._write(
+            "INSERT OR REPLACE INTO results (sha256, version, data, used_at) VALUES (?, ?, ?, ?)",
+            (sha256, version, json.dumps(data, ensure_ascii=False, default=str), time.time())
+        )
+
+    def evict(self):
+        """Drops the least recently used entries above max_entries."""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM results WHERE sha256 IN ("
+                " SELECT sha256 FROM results ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
@@ -0,0 +1,223 @@
+import os
+import time
+import queue
+import threading
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import Future
+from typing import Optional
+from src import metrics
+from src.dedupe_index import file_sha256
+from src.extraction_service import has_invoice_fields
+
+# Outcome of one extraction job.
+# status is "ok", "empty" (readable, but no invoice field found), "timeout", "oversize" or "error";
+# data is the extracted dict (the partial one for "empty", {} for the other failures).
+ExtractionResult = namedtuple("ExtractionResult", ["status", "data", "elapsed", "error"])
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def _worker_main(conn, extraction_service):
+    """Worker process loop: receives (PDF path, sender), sends back (status, data or error message)."""
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        pdf_path, sender = job
+        try:
+            conn.send(("ok", extraction_service.extract_data(pdf_path, sender=sender)))
+        except MemoryError:
+            conn.send(("oversize", "MemoryError while extracting"))
+        except Exception as e:
+            conn.send(("error", str(e)))
+
+
+def _rss_bytes(pid: int) -> Optional[int]:
+    """Resident set size of a process, read from /proc (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class _Worker:
+    def __init__(self, context, extraction_service):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child_conn, extraction_service),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.documents = 0
+
+    def stop(self, kill: bool = False):
+        try:
+            if kill:
+                self.process.kill()
+            else:
+                self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class ExtractionExecutor:
+    """
+    Runs ExtractionService.extract_data in a pool of worker processes.
+
+    Each document gets a wall-clock timeout and a resident-memory limit; a worker that
+    exceeds either is killed and replaced, and the job resolves to a "timeout" or
+    "oversize" ExtractionResult instead of blocking the caller. Workers are also
+    recycled after max_documents jobs to contain slow memory leaks in pdfminer.
+
+    With an ExtractionCache, documents already extracted by the current extractor version
+    are answered from the cache without reaching a worker.
+    """
+
+    def __init__(self, extraction_service, workers: int = None, cache=None):
+        self.extraction_service = extraction_service
+        self.cache = cache
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = float(os.getenv("EXTRACTION_TIMEOUT", 60))
+        self.memory_limit_bytes = int(os.getenv("EXTRACTION_MEMORY_LIMIT_MB", 1024)) * 1024 * 1024
+        self.max_documents = int(os.getenv("EXTRACTION_MAX_DOCUMENTS_PER_WORKER", 100))
+        # How often the RSS of a busy worker is checked
+        self.poll_interval = 0.2
+
+        # spawn: the parent process runs threads, which fork() does not handle safely
+        self._context = multiprocessing.get_context("spawn")
+        self._jobs = queue.Queue()
+        self._threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._dispatch, name=f"extraction-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, pdf_path: str, sender: str = None, digest: str = None) -> Future:
+        """
+        Queues a PDF for extraction. The future resolves to an ExtractionResult.
+        digest: SHA-256 of the PDF, if the caller has it already (computed otherwise when caching).
+        """
+        future = Future()
+        cache_key = None
+        if self.cache is not None:
+            cache_key = (digest or file_sha256(pdf_path), self.extraction_service.cache_version(sender))
+            data = self._cache_lookup(cache_key)
+            if data is not None:
+                metrics.inc("invoice_extraction_cache_hits_total")
+                future.set_result(ExtractionResult("ok", data, 0.0, None))
+                return future
+        self._jobs.put((pdf_path, sender, cache_key, future))
+        return future
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _dispatch(self):
+        """Feeds jobs to one worker process, replacing it when it misbehaves or is worn out."""
+        worker = None
+        try:
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    return
+                pdf_path, sender, cache_key, future = job
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                try:
+                    if worker is None:
+                        worker = _Worker(self._context, self.extraction_service)
+
+                    result = self._run_job(worker, pdf_path, sender)
+                    worker.documents += 1
+                    # Timed here, in the parent: worker processes do not collect metrics
+                    metrics.observe(metrics.STAGE_SECONDS, result.elapsed, stage="extract")
+                    metrics.inc("invoice_documents_total", stage=f"extract_{result.status}")
+
+                    if result.status in ("timeout", "oversize") or not worker.process.is_alive():
+                        worker.stop(kill=True)
+                        worker = None
+                    elif worker.documents >= self.max_documents:
+                        worker.stop()
+                        worker = None
+                except Exception as e:
+                    # The future must resolve whatever happens, or the email waits on it forever
+                    print(f"Extraction dispatcher error for {pdf_path}: {e}")
+                    if worker is not None:
+                        worker.stop(kill=True)
+                        worker = None
+                    result = ExtractionResult("error", {}, 0.0, f"Extraction dispatcher error: {e}")
+
+                # Only complete extractions are cached; empty results, timeouts and errors are retried next time
+                if cache_key and result.status == "ok":
+                    self._cache_store(cache_key, result.data)
+                future.set_result(result)
+        finally:
+            if worker is not None:
+                worker.stop()
+
+    def _cache_lookup(self, cache_key: tuple) -> Optional[dict]:
+        """The cache is an optimisation: when it fails (e.g. locked by another process), extract instead."""
+        try:
+            return self.cache.lookup(*cache_key)
+        except Exception as e:
+            print(f"Warning: extraction cache lookup failed: {e}")
+            return None
+
+    def _cache_store(self, cache_key: tuple, data: dict):
+        try:
+            self.cache.store(*cache_key, data)
+        except Exception as e:
+            print(f"Warning: could not store extraction in the cache: {e}")
+
+    def _run_job(self, worker: _Worker, pdf_path: str, sender: Optional[str]) -> ExtractionResult:
+        start = time.monotonic()
+        try:
+            worker.conn.send((pdf_path, sender))
+        except (OSError, ValueError) as e:
+            return ExtractionResult("error", {}, 0.0, f"Extraction worker unavailable: {e}")
+
+        deadline = start + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                print(f"Extraction timed out after {self.timeout:.0f}s: {pdf_path}")
+                return ExtractionResult("timeout", {}, time.monotonic() - start, f"Timed out after {self.timeout:.0f}s")
+
+            try:
+                ready = worker.conn.poll(min(self.poll_interval, remaining))
+            except (OSError, EOFError):
+                ready = True
+            if ready:
+                try:
+                    status, payload = worker.conn.recv()
+                except (OSError, EOFError):
+                    return ExtractionResult("error", {}, time.monotonic() - start, "Extraction worker died")
+                elapsed = time.monotonic() - start
+                if status == "ok":
+                    if not has_invoice_fields(payload or {}):
+                        return ExtractionResult("empty", payload or {}, elapsed, "No invoice fields found in the text")
+                    return ExtractionResult("ok", payload, elapsed, None)
+                if status == "oversize":
+                    print(f"Extraction ran out of memory: {pdf_path}")
+                return ExtractionResult(status, {}, elapsed, payload)
+
+            rss = _rss_bytes(worker.process.pid)
+            if self.memory_limit_bytes and rss and rss > self.memory_limit_bytes:
+                print(f"Extraction exceeded {self.memory_limit_bytes // (1024 * 1024)} MB: {pdf_path}")
+                return ExtractionResult("oversize", {}, time.monotonic() - start, f"Resident memory above {self.memory_limit_bytes // (1024 * 1024)} MB")
@@ -1,9 +1,237 @@
+import os
 import pdfplumber
+import pypdfium2 as pdfium
 import re
-from typing import Dict, Optional
+from abc import ABC, abstractmethod
+from contextlib import ExitStack, contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+from src.vendor_templates import TemplateRegistry
+
+class TextBackend(ABC):
+    """
+    Extracts plain text from PDFs.
+    open() yields a document exposing len() and page_text(index), so callers can read
+    only the pages they need.
+    """
+    name = ""
+
+    @abstractmethod
+    def open(self, pdf_path: str):
+        """Context manager yielding the opened document (implement with @contextmanager)."""
+
+    def iter_pages(self, pdf_path: str) -> Iterator[str]:
+        with self.open(pdf_path) as document:
+            for index in range(len(document)):
+                yield document.page_text(index)
+
+class PdfiumBackend(TextBackend):
+    """Fast path: PDFium's text layer, without building per-character layout objects."""
+    name = "pdfium"
+
+    @contextmanager
+    def open(self, pdf_path: str):
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            yield _PdfiumDocument(pdf)
+        finally:
+            pdf.close()
+
+class _PdfiumDocument:
+    def __init__(self, pdf):
+        self.pdf = pdf
+
+    def __len__(self):
+        return len(self.pdf)
+
+    def page_text(self, index: int) -> str:
+        page = self.pdf[index]
+        textpage = page.get_textpage()
+        try:
+            # PDFium separates lines with CRLF
+            return (textpage.get_text_range() or "").replace("\r\n", "\n")
+        finally:
+            textpage.close()
+            page.close()
+
+class PdfplumberBackend(TextBackend):
+    """Slow but layout-aware: pdfplumber/pdfminer character layout analysis."""
+    name = "pdfplumber"
+
+    def __init__(self, layout: bool = False):
+        self.layout = layout
+
+    @contextmanager
+    def open(self, pdf_path: str):
+        with pdfplumber.open(pdf_path) as pdf:
+            yield _PdfplumberDocument(pdf, self.layout)
+
+class _PdfplumberDocument:
+    def __init__(self, pdf, layout: bool):
+        self.pdf = pdf
+        self.layout = layout
+
+    def __len__(self):
+        return len(self.pdf.pages)
+
+    def page_text(self, index: int) -> str:
+        page = self.pdf.pages[index]
+        try:
+            # extract_text() returns None for pages without a text layer
+            return page.extract_text(layout=self.layout) or ""
+        finally:
+            # Drop cached layout objects; they dominate pdfplumber's memory use
+            page.close()
+
+TEXT_BACKENDS = {
+    PdfiumBackend.name: PdfiumBackend,
+    PdfplumberBackend.name: PdfplumberBackend,
+}
+
+def is_usable_text(text: str, min_chars: int = 20) -> bool:
+    """
+    Cheap quality check for extracted text: enough visible characters, and not mostly
+    replacement/control characters (a sign of a broken font encoding).
+    """
+    visible = [c for c in text if not c.isspace()]
+    if len(visible) < min_chars:
+        return False
+    garbage = sum(1 for c in visible if c == "\ufffd" or (ord(c) < 32) or 0xE000 <= ord(c) <= 0xF8FF)
+    return garbage / len(visible) < 0.1
+
+# Precompiled field patterns (Hungarian and English invoice labels)
+INVOICE_NUMBER_PATTERN = re.compile(
+    # "Számla sorszáma" consumes its trailing "a", or the number group would fail on it
+    r'(?:Számla\s*sz[aá]ma?|(?:Számla\s*)?sorsz[aá]ma?|Számlaszám|Díjbekérő\s*sz[aá]ma?|Invoice\s*(?:No\.?|number))\s*[:.#]?\s*'
+    # The number itself is matched case-sensitively and must contain a digit, so words after the label are skipped
+    r'(?-i:((?=[A-Z\-/]*\d)[A-Z0-9][A-Z0-9\-/]{2,}))',
+    re.IGNORECASE
+)
+TAX_ID_PATTERN = re.compile(r'\b(\d{8}-\d-\d{2})\b')
+DATE = r'(\d{4})\s*[.\-/]\s*(\d{1,2})\s*[.\-/]\s*(\d{1,2})'
+ISSUE_DATE_PATTERN = re.compile(
+    r'(?:Számla\s*kelte|Kiállítás\s*(?:dátuma|kelte)|Kelt(?:e|ezés)?|Kiállítva|Invoice\s*date|Issue\s*date)[^\d\n]{0,30}' + DATE,
+    re.IGNORECASE
+)
+DUE_DATE_PATTERN = re.compile(
+    r'(?:Fizetési\s*határid[őo]|Esedékesség|Due\s*date)[^\d\n]{0,30}' + DATE,
+    re.IGNORECASE
+)
+AMOUNT_PATTERN = re.compile(r'([\d \u00a0\.,]+)\s*(?:Ft|HUF)', re.IGNORECASE)
+TOTAL_PATTERN = re.compile(
+    r'(?:Fizetendő(?:\s*összeg)?|Végösszeg|Bruttó\s*(?:összesen|végösszeg)|Total\s*(?:due|amount)?)[^\d\n]{0,30}([\d \u00a0\.,]+)\s*(?:Ft|HUF)',
+    re.IGNORECASE
+)
+VENDOR_PATTERN = re.compile(r'(?:Szállító|Eladó|Kiállító|Vendor|Seller)\s*(?:neve)?\s*:\s*([^\n]*)\n?([^\n]*)', re.IGNORECASE)
+BUYER_PATTERN = re.compile(r'(?:Vevő|Megrendelő|Buyer|Customer)\s*(?:neve)?\s*:\s*([^\n]*)\n?([^\n]*)', re.IGNORECASE)
+PROFORMA_PATTERN = re.compile(r'Díjbekérő|Előlegbekérő|Proforma', re.IGNORECASE)
+
+# Fields that must be found before extraction stops reading pages
+REQUIRED_FIELDS = ("invoice_number", "vendor", "vendor_tax_id", "issue_date", "due_date", "amount", "buyer")
+
+def has_invoice_fields(data: dict) -> bool:
+    """
+    True if an extraction found at least one field. The type and comment are always set, and
+    a vendor guessed from the first line of text (vendor_guessed) does not count either.
+    """
+    return any(
+        data.get(field) for field in REQUIRED_FIELDS
+        if not (field == "vendor" and data.get("vendor_guessed"))
+    )
+
+def parse_page_budget(value: str):
+    """
+    Parses a page budget like "2,1" (first 2 pages plus last 1 page).
+    An empty value means no budget: every page is read.
+    """
+    if not value:
+        return None
+    first, _, last = value.partition(",")
+    return int(first or 0), int(last or 0)
+
+def select_pages(page_count: int, budget) -> list:
+    """Page indices to read, in order: the first pages of the budget, then the last ones."""
+    if budget is None or sum(budget) >= page_count:
+        return list(range(page_count))
+    first, last = budget
+    return list(range(first)) + list(range(page_count - last, page_count))
+
+def parse_amount(raw: str) -> Optional[float]:
+    # Clean the number: remove spaces, replace decimal separator
+    clean_num = raw.replace(' ', '').replace('\u00a0', '').strip('.')
+    # If it has a comma, replace with dot (Hungarian standard: 1234,56 -> 1234.56)
+    # But if it has multiple dots, it might be 1.234.567 -> 1234567
+    
+    if ',' in clean_num:
+        clean_num = clean_num.replace('.', '').replace(',', '.')
+    else:
+        # If only dots, check if it's a thousand separator or decimal
+        # 1.234 -> 1234; 12.34 -> 12.34
+        # This is ambiguous without context. Let's assume dot is thousand sep if followed by 3 digits?
+        # For simplicity, let's assume integers for now if no comma.
+        pass
+    
+    try:
+        return float(clean_num)
+    except ValueError:
+        return None
+
+# Bump when a change to the extraction logic should invalidate cached results
+EXTRACTOR_VERSION = "4"
+
+def format_date(year: str, month: str, day: str) -> str:
+    return f"{year}-{int(month):02d}-{int(day):02d}"
 
 class ExtractionService:
-    def extract_data(self, pdf_path):
+    def __init__(self, text_backend: str = None, layout: bool = False, page_budget: str = None, templates: TemplateRegistry = None):
+        """
+        text_backend: name from TEXT_BACKENDS (default: EXTRACTION_TEXT_BACKEND or "pdfium").
+        layout: layout-aware parsing is needed, which only pdfplumber provides.
+        page_budget: pages to read, e.g. "2,1" for the first 2 and the last page
+        (default: EXTRACTION_PAGE_BUDGET; empty reads every page).
+        templates: vendor templates (default: loaded from EXTRACTION_TEMPLATES_PATH).
+        """
+        name = text_backend or os.getenv("EXTRACTION_TEXT_BACKEND", PdfiumBackend.name)
+        if layout:
+            self.text_backend = PdfplumberBackend(layout=True)
+        else:
+            self.text_backend = TEXT_BACKENDS[name]()
+        # pdfplumber is the fallback when the fast path yields empty or garbled text
+        self.fallback_backend = None if isinstance(self.text_backend, PdfplumberBackend) else PdfplumberBackend()
+        self.page_budget = parse_page_budget(page_budget if page_budget is not None else os.getenv("EXTRACTION_PAGE_BUDGET", "2,1"))
+        self.templates = templates if templates is not None else TemplateRegistry()
+
+    def cache_version(self, sender: str = None) -> str:
+        """
+        Everything besides the PDF bytes that determines extract_data's result: the extractor
+        version, text backend, page budget and templates (and the sender's domain, when
+        templates are matched by domain).
+        """
+        version = f"{EXTRACTOR_VERSION}:{self.text_backend.name}:{self.page_budget}:{self.templates.version}"
+        if self.templates.by_domain and sender:
+            version += ":" + sender.rpartition("@")[2].lower()
+        return version
+
+    def _iter_page_texts(self, pdf_path: str) -> Iterator[Tuple[int, int, str]]:
+        """
+        Yields (page index, page count, text) for the pages within the page budget, one page at a time.
+        A page whose fast-path text is empty or garbled is re-read with the fallback backend.
+        """
+        with ExitStack() as stack:
+            document = stack.enter_context(self.text_backend.open(pdf_path))
+            fallback = None
+            
+            page_count = len(document)
+            for index in select_pages(page_count, self.page_budget):
+                text = document.page_text(index)
+                if self.fallback_backend and not is_usable_text(text):
+                    if fallback is None:
+                        fallback = stack.enter_context(self.fallback_backend.open(pdf_path))
+                    fallback_text = fallback.page_text(index)
+                    if len(fallback_text.strip()) > len(text.strip()):
+                        text = fallback_text
+                yield index, page_count, text
+
+    def extract_data(self, pdf_path, sender: str = None):
         """
         Extracts key data from the PDF invoice.
         Returns a dictionary with:
@@ -15,16 +243,12 @@ class ExtractionService:
         - due_date
         - amount
         - buyer
+        - vendor_guessed (only when vendor is the first line of text, not a labelled name)
+        Unreadable PDFs raise; the caller (ExtractionExecutor) reports them as failed.
+        Pages are processed one at a time and reading stops as soon as every field is filled.
+        The first page's tax id (or the sender address) selects a vendor template, whose
+        scoped patterns run before the generic ones; the generic patterns fill what is left.
         """
-        text = ""
-        try:
-            with pdfplumber.open(pdf_path) as pdf:
-                for page in pdf.pages:
-                    text += page.extract_text() + "\n"
-        except Exception as e:
-            print(f"Error reading PDF: {e}")
-            return {}
-
         data = {
             "type": "Számla", # Default
             "invoice_number": "",
@@ -36,34 +260,100 @@ class ExtractionService:
             "buyer": "",
             "comment": ""
         }
+        # Fallback total: the largest amount seen, used when no labelled total is found
+        largest_amount = None
+        first_page_text = None
+        template = None
+
+        for index, page_count, text in self._iter_page_texts(pdf_path):
+            if first_page_text is None:
+                first_page_text = text
+                template = self._match_template(text, sender, data)
+                
+            if template:
+                self._apply_template(template, text, index, page_count, data)
+            self._extract_fields(text, data)
+            
+            if not data["amount"]:
+                for m in AMOUNT_PATTERN.findall(text):
+                    amount = parse_amount(m)
+                    if amount is not None and (largest_amount is None or amount > largest_amount):
+                        largest_amount = amount
+                        
+            if all(data[field] for field in REQUIRED_FIELDS):
+                break
 
-        amount_pattern = r'([\d\s\.,]+)\s*(?:Ft|HUF)'
-        matches = re.findall(amount_pattern, text, re.IGNORECASE)
-        
-        amounts = []
-        for m in matches:
-            # Clean the number: remove spaces, replace decimal separator
-            clean_num = m.replace(' ', '')
-            # If it has a comma, replace with dot (Hungarian standard: 1234,56 -> 1234.56)
-            # But if it has multiple dots, it might be 1.234.567 -> 1234567
+        if not data["amount"] and largest_amount is not None:
+            data["amount"] = largest_amount # Assumption: Invoice total is the largest amount
+        if not data["vendor"] and first_page_text:
+            data["vendor"] = self._extract_vendor(first_page_text)
+            data["vendor_guessed"] = True
             
-            if ',' in clean_num:
-                clean_num = clean_num.replace('.', '').replace(',', '.')
-            else:
-                # If only dots, check if it's a thousand separator or decimal
-                # 1.234 -> 1234; 12.34 -> 12.34
-                # This is ambiguous without context. Let's assume dot is thousand sep if followed by 3 digits?
-                # For simplicity, let's assume integers for now if no comma.
-                pass
+        return data
+
+    def _extract_fields(self, text: str, data: Dict[str, str]):
+        """Fills the still-empty fields of data from one page of text."""
+        if data["type"] == "Számla" and PROFORMA_PATTERN.search(text):
+            data["type"] = "Díjbekérő"
             
-            try:
-                amounts.append(float(clean_num))
-            except ValueError:
-                continue
+        if not data["invoice_number"]:
+            match = INVOICE_NUMBER_PATTERN.search(text)
+            if match:
+                data["invoice_number"] = match.group(1)
                 
-        if amounts:
-            return max(amounts) # Assumption: Invoice total is the largest amount
-        return None
+        if not data["vendor_tax_id"]:
+            # The seller's block comes first on Hungarian invoices
+            match = TAX_ID_PATTERN.search(text)
+            if match:
+                data["vendor_tax_id"] = match.group(1)
+                
+        for field, pattern in (("issue_date", ISSUE_DATE_PATTERN), ("due_date", DUE_DATE_PATTERN)):
+            if not data[field]:
+                match = pattern.search(text)
+                if match:
+                    data[field] = format_date(*match.groups())
+                    
+        if not data["amount"]:
+            match = TOTAL_PATTERN.search(text)
+            if match:
+                amount = parse_amount(match.group(1))
+                if amount is not None:
+                    data["amount"] = amount
+                    
+        for field, pattern in (("vendor", VENDOR_PATTERN), ("buyer", BUYER_PATTERN)):
+            if not data[field]:
+                match = pattern.search(text)
+                if match:
+                    # The name is either on the label's line or on the next one
+                    name = match.group(1).strip() or match.group(2).strip()
+                    if name:
+                        data[field] = name
+
+    def _match_template(self, first_page_text: str, sender: Optional[str], data: Dict[str, str]):
+        """Header detection: the first tax id on the first page (the seller's), then the sender's domain."""
+        if not len(self.templates):
+            return None
+        match = TAX_ID_PATTERN.search(first_page_text)
+        template = self.templates.match(tax_id=match.group(1) if match else None, sender=sender)
+        if template:
+            data["vendor"] = template.vendor
+            if template.tax_ids:
+                # The vendor's id as printed on this invoice (vendors may have several); the first
+                # listed id only for a match by sender domain on a page that shows none of them
+                on_page = [tax_id for tax_id in TAX_ID_PATTERN.findall(first_page_text) if tax_id in template.tax_ids]
+                data["vendor_tax_id"] = on_page[0] if on_page else template.tax_ids[0]
+        return template
+
+    def _apply_template(self, template, text: str, index: int, page_count: int, data: Dict[str, str]):
+        for field, groups in template.extract(text, index, page_count, data).items():
+            if field in ("issue_date", "due_date") and len(groups) == 3:
+                value = format_date(*groups)
+            elif field == "amount":
+                value = parse_amount(groups[0] or "")
+            else:
+                value = (groups[0] or "").strip()
+            if value:
+                data[field] = value
 
     def _extract_vendor(self, text: str) -> Optional[str]:
         # Very naive: First non-empty line?
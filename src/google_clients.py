@@ -0,0 +1,224 @@
+import os
+import re
+import json
+import queue
+import datetime
+import threading
+from typing import Optional
+from google.oauth2 import service_account
+from googleapiclient.discovery import build
+from googleapiclient.http import build_http
+from google_auth_httplib2 import AuthorizedHttp, Request
+from src import metrics
+from src.rate_limit import TokenBucket
+
+# One token covers every API the automation talks to
+SCOPES = [
+    'https://www.googleapis.com/auth/drive',
+    'https://www.googleapis.com/auth/spreadsheets',
+]
+
+# Quota (429) and transient server errors are retried with backoff
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+# Matches the scheme and host of every Google API endpoint (including the OAuth token endpoint)
+GOOGLE_API_HOST = re.compile(r'^https://([a-z0-9.-]+\.googleapis\.com)')
+
+# Optional client-side request rate limits (requests/second) per API host, to stay inside quotas
+RATE_LIMIT_SETTINGS = {
+    'www.googleapis.com': ('drive', 'GOOGLE_DRIVE_MAX_RPS'),
+    'drive.googleapis.com': ('drive', 'GOOGLE_DRIVE_MAX_RPS'),
+    'sheets.googleapis.com': ('sheets', 'GOOGLE_SHEETS_MAX_RPS'),
+}
+
+_lock = threading.Lock()
+_credentials = None
+_credentials_loaded = False
+_http = None
+_refresher = None
+
+
+class HttpPool:
+    """
+    Thread-safe stand-in for httplib2.Http shared by every Google client.
+
+    httplib2.Http is not thread-safe, so each request borrows an idle Http (and its
+    kept-alive HTTPS connection) from the pool and returns it afterwards. At most `size`
+    requests run at the same time; further callers wait for a free connection.
+    With GOOGLE_DRIVE_MAX_RPS / GOOGLE_SHEETS_MAX_RPS set, requests to that API also wait
+    for a token of its rate limiter first.
+    """
+
+    def __init__(self, size: int = None):
+        self.size = size or int(os.getenv("GOOGLE_HTTP_POOL_SIZE", 10))
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        # Sends every Google API request to another server instead, e.g. the benchmark stand-ins
+        self.base_url = (os.getenv("GOOGLE_API_BASE_URL") or "").rstrip("/") or None
+        self._limits = {}
+        buckets = {}
+        for host, (api, variable) in RATE_LIMIT_SETTINGS.items():
+            rate = float(os.getenv(variable) or 0)
+            if rate > 0:
+                if api not in buckets:
+                    buckets[api] = TokenBucket(rate)
+                self._limits[host] = (api, buckets[api])
+
+        # build_http() sets the default timeout and disables following 308s (resumable uploads need them)
+        template = build_http()
+        self.timeout = template.timeout
+        self.redirect_codes = template.redirect_codes
+        self.follow_redirects = template.follow_redirects
+        self._idle.put(template)
+
+    def request(self, uri, *args, **kwargs):
+        match = GOOGLE_API_HOST.match(uri)
+        if match and match.group(1) in self._limits:
+            api, bucket = self._limits[match.group(1)]
+            waited = bucket.acquire()
+            if waited:
+                metrics.inc("invoice_api_throttled_seconds_total", waited, api=api)
+        if match and self.base_url:
+            uri = self.base_url + uri[match.end():]
+
+        with self._slots:
+            try:
+                http = self._idle.get_nowait()
+            except queue.Empty:
+                http = build_http()
+
+            try:
+                response = http.request(uri, *args, **kwargs)
+            except Exception:
+                # The connection may be half-used; don't hand it to the next caller
+                http.close()
+                raise
+            self._idle.put(http)
+            return response
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def load_credentials():
+    """
+    Service-account credentials, parsed once per process. Tries, in order:
+    1. GOOGLE_SERVICE_ACCOUNT_JSON (JSON content)
+    2. GOOGLE_SERVICE_ACCOUNT_FILE as a path
+    3. GOOGLE_SERVICE_ACCOUNT_FILE as JSON content
+    Returns None if none of them holds valid credentials.
+    """
+    global _credentials, _credentials_loaded
+    with _lock:
+        if not _credentials_loaded:
+            _credentials = _parse_credentials()
+            _credentials_loaded = True
+        return _credentials
+
+
+def _parse_credentials():
+    service_account_json = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
+    service_account_info = os.getenv("GOOGLE_SERVICE_ACCOUNT_FILE")
+
+    # 1. Try GOOGLE_SERVICE_ACCOUNT_JSON (Priority)
+    if service_account_json:
+        try:
+            creds = service_account.Credentials.from_service_account_info(
+                json.loads(service_account_json), scopes=SCOPES
+            )
+            print("DEBUG: Authenticated using GOOGLE_SERVICE_ACCOUNT_JSON")
+            return creds
+        except json.JSONDecodeError as e:
+            print(f"Warning: GOOGLE_SERVICE_ACCOUNT_JSON is invalid JSON: {e}")
+
+    if not service_account_info:
+        return None
+
+    # 2. Try GOOGLE_SERVICE_ACCOUNT_FILE as a file path
+    if os.path.exists(service_account_info):
+        creds = service_account.Credentials.from_service_account_file(service_account_info, scopes=SCOPES)
+        print("DEBUG: Authenticated using GOOGLE_SERVICE_ACCOUNT_FILE (path)")
+        return creds
+
+    # 3. If file doesn't exist, try to parse the variable content as JSON
+    try:
+        # Clean the string: remove whitespace and potential surrounding quotes
+        clean_info = service_account_info.strip().strip("'").strip('"')
+        creds = service_account.Credentials.from_service_account_info(json.loads(clean_info), scopes=SCOPES)
+        print("DEBUG: Authenticated using GOOGLE_SERVICE_ACCOUNT_FILE (content)")
+        return creds
+    except json.JSONDecodeError as e:
+        print(f"JSON Decode Error in FILE variable: {e}")
+        return None
+
+
+def authorized_http() -> Optional[AuthorizedHttp]:
+    """
+    The process-wide authorized transport: shared credentials over a shared HttpPool.
+    Starts the background token refresher on first use. None without credentials.
+    """
+    global _http, _refresher
+    creds = load_credentials()
+    if creds is None:
+        return None
+
+    with _lock:
+        if _http is None:
+            _http = AuthorizedHttp(creds, http=HttpPool())
+            _refresher = TokenRefresher(creds, _http.http)
+            _refresher.start()
+        return _http
+
+
+def build_service(api: str, version: str):
+    """
+    A discovery-based client over the shared transport.
+    The discovery document shipped with google-api-python-client is used, so building a
+    client makes no network request.
+    """
+    http = authorized_http()
+    if http is None:
+        raise ValueError(
+            "Could not authenticate. Neither GOOGLE_SERVICE_ACCOUNT_JSON nor GOOGLE_SERVICE_ACCOUNT_FILE provided valid credentials."
+        )
+    return build(api, version, http=http, static_discovery=True, cache_discovery=False)
+
+
+class TokenRefresher(threading.Thread):
+    """
+    Refreshes the access token refresh_margin seconds before it expires, so no request
+    ever pays for (or races on) a token refresh. Failures are retried every retry_interval
+    seconds; requests still fall back to refreshing on their own if the token lapses.
+    """
+
+    def __init__(self, creds, http):
+        super().__init__(name="google-token-refresh", daemon=True)
+        self.creds = creds
+        self.request = Request(http)
+        self.refresh_margin = float(os.getenv("GOOGLE_TOKEN_REFRESH_MARGIN", 300))
+        self.retry_interval = 30
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.creds.refresh(self.request)
+                delay = self._seconds_until_refresh()
+            except Exception as e:
+                print(f"Warning: Google token refresh failed: {e}")
+                delay = self.retry_interval
+            self._stopped.wait(delay)
+
+    def stop(self):
+        self._stopped.set()
+
+    def _seconds_until_refresh(self) -> float:
+        if not self.creds.expiry:
+            return self.retry_interval
+        # google-auth keeps expiry as a naive UTC datetime
+        remaining = (self.creds.expiry - datetime.datetime.utcnow()).total_seconds()
+        return max(remaining - self.refresh_margin, self.retry_interval)
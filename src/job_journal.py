@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import threading
+from typing import List, Optional
+from src.dedupe_index import state_dir
+
+# Pipeline stages of one (message UID, PDF) item, in order
+STAGES = ("downloaded", "uploaded", "extracted", "recorded", "flagged")
+
+
+class JobJournal:
+    """
+    Write-ahead journal of pipeline progress per (message UID, PDF SHA-256).
+
+    Every stage transition is appended as one JSON line and handed to the OS right away,
+    so a crashed process loses nothing; fsync is batched (every fsync_batch records or
+    fsync_interval seconds) to keep the per-invoice cost at a single write() call.
+    On startup the journal is replayed so an interrupted email resumes each PDF from its
+    last completed stage. Items of an email are dropped once it is flagged as read, and
+    compact() (called after every cycle) rewrites the file with only the unfinished ones.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or os.getenv("JOURNAL_PATH", os.path.join(state_dir(), "journal.jsonl"))
+        self.fsync_batch = int(os.getenv("JOURNAL_FSYNC_BATCH", 50))
+        self.fsync_interval = float(os.getenv("JOURNAL_FSYNC_INTERVAL", 5))
+        self.max_age_days = float(os.getenv("JOURNAL_MAX_AGE_DAYS", 30))
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._items = {}
+        # uid -> SHA-256s of its items, so flagging an email does not scan every item
+        self._by_uid = {}
+        self._file = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        # Lines appended since the file was last compacted
+        self._appended = 0
+
+        self._load()
+
+    def get(self, uid: str, sha256: str) -> Optional[dict]:
+        """Latest known state of an item: {'stage': ..., 'file_url': ..., 'data': ...}, or None."""
+        with self._lock:
+            item = self._items.get((str(uid), sha256))
+            return dict(item) if item else None
+
+    def record(self, uid: str, sha256: str, stage: str, **fields):
+        """Records that an item completed a stage, with stage outputs (path, file_url, data)."""
+        entry = {"uid": str(uid), "sha256": sha256, "stage": stage, "ts": time.time()}
+        entry.update(fields)
+        line = json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+
+        with self._lock:
+            self._apply(entry)
+            self._write(line)
+
+    def flag_emails(self, uids: List[str]):
+        """
+        Marks every item of these emails as finished (flagged as read, or checkpointed by a
+        backfill) and forgets them; the "flagged" lines drop them again on replay.
+        """
+        now = time.time()
+        with self._lock:
+            for uid in map(str, uids):
+                for sha256 in self._by_uid.pop(uid, ()):
+                    del self._items[(uid, sha256)]
+                    entry = {"uid": uid, "sha256": sha256, "stage": "flagged", "ts": now}
+                    self._write(json.dumps(entry) + "\n")
+
+    def compact(self):
+        """Rewrites the journal with only the unfinished, recent items, if anything was appended since the last time."""
+        with self._lock:
+            if self._appended:
+                self._compact()
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+    def _write(self, line: str):
+        self._file.write(line)
+        self._file.flush()
+        self._appended += 1
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_batch or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self._sync()
+
+    def _sync(self):
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _apply(self, entry: dict):
+        key = (entry["uid"], entry["sha256"])
+        if entry.get("stage") == "flagged":
+            self._items.pop(key, None)
+            self._by_uid.get(key[0], set()).discard(key[1])
+            return
+        item = self._items.setdefault(key, {})
+        self._by_uid.setdefault(key[0], set()).add(key[1])
+        for field, value in entry.items():
+            if field not in ("uid", "sha256"):
+                item[field] = value
+
+    def _load(self):
+        """Replays the journal, then rewrites it with only unfinished, recent items."""
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self._apply(json.loads(line))
+                    except (ValueError, KeyError):
+                        # A torn last line from a crash mid-write
+                        continue
+
+        self._compact()
+        if self._items:
+            print(f"Job journal: {len(self._items)} unfinished item(s) will resume from their last stage.")
+
+    def _compact(self):
+        # 1. Items abandoned for max_age_days (e.g. the email was deleted) are dropped too
+        cutoff = time.time() - self.max_age_days * 86400
+        self._items = {key: item for key, item in self._items.items() if item.get("ts", 0) >= cutoff}
+        self._by_uid = {}
+        for uid, sha256 in self._items:
+            self._by_uid.setdefault(uid, set()).add(sha256)
+
+        # 2. Write the live items to a new file and swap it in atomically
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for (uid, sha256), item in self._items.items():
+                entry = {"uid": uid, "sha256": sha256}
+                entry.update(item)
+                f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+        # 3. Appends continue in the new file
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._appended = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
@@ -0,0 +1,127 @@
+import os
+import httpx
+from concurrent.futures import Future, ThreadPoolExecutor
+from email.message import Message
+from typing import List, Optional
+from urllib.parse import unquote, urlsplit
+from src import metrics
+
+# A PDF's header must start within its first 1024 bytes
+PDF_MAGIC = b"%PDF-"
+MAGIC_WINDOW = 1024
+
+
+class NotAPdfError(Exception):
+    pass
+
+
+class LinkDownloader:
+    """
+    Downloads invoice PDFs from links in emails ("Számla letöltése" buttons of invoice portals).
+
+    One pooled httpx client is shared by a small thread pool, so connections to the same
+    portal are kept alive and downloads of different emails run concurrently. Bodies are
+    streamed to disk in chunks with connect/read timeouts and a size cap, and anything that
+    does not start like a PDF is rejected after the first chunk.
+    """
+
+    def __init__(self, spool, workers: int = None):
+        # Spool the downloaded files are written to, in the email's directory
+        self.spool = spool
+        self.workers = workers or int(os.getenv("LINK_DOWNLOAD_WORKERS", 4))
+        self.max_bytes = int(os.getenv("LINK_MAX_BYTES", 25 * 1024 * 1024))
+        self.chunk_size = 64 * 1024
+
+        timeout = httpx.Timeout(
+            connect=float(os.getenv("LINK_CONNECT_TIMEOUT", 10)),
+            read=float(os.getenv("LINK_READ_TIMEOUT", 30)),
+            write=10.0,
+            pool=60.0,
+        )
+        # httpx.Client is thread-safe; idle connections are kept per host
+        self.client = httpx.Client(
+            timeout=timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=self.workers * 2, max_keepalive_connections=self.workers),
+            headers={"User-Agent": "invoice-automation"},
+        )
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="link-download")
+
+    def submit(self, urls: List[str], uid: str) -> Future:
+        """Downloads the first of urls that yields a PDF, in the background. Future[Optional[str]]."""
+        return self._pool.submit(self.download_first, urls, uid)
+
+    def download_first(self, urls: List[str], uid: str) -> Optional[str]:
+        for url in urls:
+            filepath = self.download(url, uid)
+            if filepath:
+                # Usually one main CTA is enough.
+                return filepath
+        return None
+
+    def download(self, url: str, uid: str) -> Optional[str]:
+        """Streams one URL to a new spool file of the email. Returns the path, or None if it is not a usable PDF."""
+        filepath = None
+        try:
+            with metrics.timer("link_download"), self.client.stream("GET", url) as response:
+                response.raise_for_status()
+
+                length = response.headers.get("content-length")
+                if length and length.isdigit() and int(length) > self.max_bytes:
+                    print(f"URL response too large ({length} bytes): {url}")
+                    return None
+
+                chunks = response.iter_bytes(self.chunk_size)
+                head = b""
+                for chunk in chunks:
+                    head += chunk
+                    if len(head) >= MAGIC_WINDOW:
+                        break
+                # Viewer pages and login forms are rejected before the rest of the body is read
+                if PDF_MAGIC not in head[:MAGIC_WINDOW]:
+                    raise NotAPdfError(f"URL did not return a PDF: {url}")
+
+                size_hint = int(length) if length and length.isdigit() else None
+                filepath, f = self.spool.create(uid, self._filename(response, url), size_hint)
+                size = len(head)
+                with f:
+                    f.write(head)
+                    for chunk in chunks:
+                        size += len(chunk)
+                        if size > self.max_bytes:
+                            raise ValueError(f"URL response exceeds {self.max_bytes} bytes: {url}")
+                        f.write(chunk)
+            self.spool.add(uid, filepath)
+            metrics.inc("invoice_bytes_fetched_total", size, source="link")
+
+            print(f"Downloaded from URL: {filepath}")
+            return filepath
+
+        except Exception as e:
+            print(f"Error downloading from URL {url}: {e}")
+            metrics.inc("invoice_api_errors_total", api="link_download")
+            if filepath and os.path.exists(filepath):
+                os.remove(filepath)
+            return None
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        self.client.close()
+
+    @staticmethod
+    def _filename(response: httpx.Response, url: str) -> str:
+        # Content-Disposition first (including RFC 2231 filename*=), then the last URL path segment
+        filename = None
+        content_disposition = response.headers.get("content-disposition")
+        if content_disposition:
+            header = Message()
+            header["content-disposition"] = content_disposition
+            filename = header.get_filename()
+        if not filename:
+            filename = unquote(urlsplit(str(response.url or url)).path.rsplit("/", 1)[-1])
+
+        # Never let a server-supplied name escape the download folder
+        filename = os.path.basename(filename.replace("\\", "/")).strip() or "invoice_download"
+        if not filename.lower().endswith(".pdf"):
+            filename += ".pdf"
+        return filename
@@ -0,0 +1,266 @@
+"""
+Per-stage timing and counters for the invoice pipeline.
+
+Disabled by default. configure() (called from main() after the .env file is loaded)
+turns collection on when METRICS_ENABLED is set; until then every call below returns
+right away and timer() hands back a shared no-op context manager.
+
+Collected values are exposed in the Prometheus text format, written to METRICS_FILE at
+the end of every cycle (for node_exporter's textfile collector) and/or served on
+http://0.0.0.0:METRICS_PORT/metrics. With METRICS_CYCLE_SUMMARY, end_cycle() also prints
+a per-stage profile of the cycle that just finished.
+"""
+import os
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+STAGE_SECONDS = "invoice_stage_duration_seconds"
+HELP = {
+    STAGE_SECONDS: "Duration of pipeline stage calls",
+    "invoice_documents_total": "Documents that went through a stage",
+    "invoice_bytes_fetched_total": "Bytes downloaded, by source",
+    "invoice_api_errors_total": "Failed API calls (after retries), by API",
+    "invoice_api_retries_total": "Retried API calls, by API",
+    "invoice_api_throttled_seconds_total": "Time API calls waited for the client-side rate limiter, by API",
+    "invoice_extraction_cache_hits_total": "Extractions answered from the extraction cache",
+    "invoice_alerts_total": "Error alerts, by outcome (sent, coalesced into a digest, digest, failed)",
+}
+
+enabled = False
+_file_path = None
+_cycle_summary = False
+# Raw stage durations, for exact percentiles (benchmarks); off in production as it grows unbounded
+_keep_samples = False
+_samples = {}
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_cycle_start = {}
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class _Timer:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(STAGE_SECONDS, time.perf_counter() - self.start, stage=self.stage)
+        return False
+
+
+class _NoopTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+def configure():
+    """Reads METRICS_* from the environment and starts the HTTP endpoint if one is configured."""
+    global enabled, _file_path, _cycle_summary, _keep_samples
+    enabled = os.getenv("METRICS_ENABLED", "false").lower() in ("1", "true", "yes")
+    if not enabled:
+        return
+    _file_path = os.getenv("METRICS_FILE") or None
+    _cycle_summary = os.getenv("METRICS_CYCLE_SUMMARY", "false").lower() in ("1", "true", "yes")
+    _keep_samples = os.getenv("METRICS_KEEP_SAMPLES", "false").lower() in ("1", "true", "yes")
+
+    port = os.getenv("METRICS_PORT")
+    if port:
+        server = ThreadingHTTPServer(("0.0.0.0", int(port)), _MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        print(f"Metrics served on port {port} at /metrics")
+
+
+def timer(stage: str):
+    """Context manager timing one call of a stage: `with metrics.timer("drive_upload"): ...`"""
+    if not enabled:
+        return _NOOP_TIMER
+    return _Timer(stage)
+
+
+def inc(name: str, value: float = 1, **labels):
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels):
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = _Histogram()
+        histogram.observe(value)
+        if _keep_samples and name == STAGE_SECONDS:
+            _samples.setdefault(labels.get("stage", ""), []).append(value)
+
+
+def samples() -> dict:
+    """Every recorded duration per stage (stage -> list of seconds); empty unless METRICS_KEEP_SAMPLES is set."""
+    with _lock:
+        return {stage: list(values) for stage, values in _samples.items()}
+
+
+def snapshot() -> dict:
+    """The collected counters and histograms as plain data, e.g. to send to another process."""
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "histograms": {key: (list(h.counts), h.sum, h.count) for key, h in _histograms.items()},
+        }
+
+
+def merge(other: dict):
+    """Adds a snapshot() taken in another process (e.g. a backfill shard) to this process's metrics."""
+    if not enabled:
+        return
+    with _lock:
+        for key, value in other["counters"].items():
+            _counters[key] = _counters.get(key, 0) + value
+        for key, (counts, total, count) in other["histograms"].items():
+            histogram = _histograms.get(key)
+            if histogram is None:
+                histogram = _histograms[key] = _Histogram()
+            histogram.counts = [mine + theirs for mine, theirs in zip(histogram.counts, counts)]
+            histogram.sum += total
+            histogram.count += count
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, (list(h.counts), h.sum, h.count)) for key, h in _histograms.items())
+
+    seen = set()
+    for (name, labels), value in counters:
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_labels(labels)} {value:g}")
+
+    for (name, labels), (counts, total, count) in histograms:
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS, counts):
+            cumulative += bucket_count
+            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+            lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labels)} {total:.6f}")
+        lines.append(f"{name}_count{_labels(labels)} {count}")
+
+    return "\n".join(lines) + "\n"
+
+
+def end_cycle():
+    """Writes METRICS_FILE and prints the cycle's stage profile (if enabled)."""
+    if not enabled:
+        return
+    if _file_path:
+        directory = os.path.dirname(_file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = _file_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(render())
+        # Atomic, so the collector never reads a half-written file
+        os.replace(tmp_path, _file_path)
+    if _cycle_summary:
+        print(cycle_summary())
+
+    with _lock:
+        for key, histogram in _histograms.items():
+            _cycle_start[key] = (list(histogram.counts), histogram.sum, histogram.count)
+
+
+def cycle_summary() -> str:
+    """Per-stage calls, total and mean time and approximate p95 since the previous end_cycle()."""
+    rows = []
+    with _lock:
+        for (name, labels), histogram in sorted(_histograms.items()):
+            if name != STAGE_SECONDS:
+                continue
+            start_counts, start_sum, start_count = _cycle_start.get((name, labels), ([0] * len(BUCKETS), 0.0, 0))
+            count = histogram.count - start_count
+            if not count:
+                continue
+            total = histogram.sum - start_sum
+            counts = [now - before for now, before in zip(histogram.counts, start_counts)]
+            rows.append((dict(labels).get("stage", ""), count, total, _quantile_bound(counts, count, 0.95)))
+
+    lines = ["Cycle profile:", f"  {'stage':<16} {'calls':>6} {'total s':>9} {'mean ms':>9} {'p95 <= s':>9}"]
+    for stage, count, total, p95 in sorted(rows, key=lambda row: -row[2]):
+        lines.append(f"  {stage:<16} {count:>6} {total:>9.2f} {total / count * 1000:>9.1f} {p95:>9g}")
+    return "\n".join(lines)
+
+
+def _quantile_bound(counts: list, count: int, quantile: float) -> float:
+    """Upper bound of the bucket holding the given quantile."""
+    cumulative = 0
+    for bound, bucket_count in zip(BUCKETS, counts):
+        cumulative += bucket_count
+        if cumulative >= quantile * count:
+            return bound
+    return BUCKETS[-1]
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise print a line every few seconds
+        pass
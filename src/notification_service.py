@@ -1,55 +1,245 @@
 import os
+import re
+import html
+import queue
+import atexit
 import smtplib
+import datetime
+import threading
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from src import metrics
+from src.rate_limit import TokenBucket
+
+# Parts of an error message that differ between occurrences of the same error
+_VOLATILE = re.compile(r"'[^']*'|\"[^\"]*\"|\b[0-9a-f]{8,}\b|\d+")
+
+
+def error_signature(error_message: str, context: str = "") -> str:
+    """Groups alerts of the same error: quoted names (e.g. email subjects), ids and numbers are ignored."""
+    first_line = (error_message or "").strip().split("\n", 1)[0]
+    return f"{context}|{_VOLATILE.sub('#', first_line)}"
+
 
 class NotificationService:
+    """
+    Sends error alerts by email without blocking the caller.
+
+    send_error_alert() only queues the alert; a background thread delivers it over one
+    persistent SMTP connection. The first alert of an error signature is sent right away;
+    repeats within alert_window seconds are counted and sent as one digest when the window
+    ends, so an outage that fails every email produces one alert plus one digest per window
+    instead of one email per failure. A token bucket caps the emails sent overall
+    (ALERT_MAX_PER_HOUR, bursts of ALERT_BURST); alerts over the limit wait in the digest.
+    """
+
     def __init__(self):
         self.host = os.getenv("EMAIL_HOST", "smtp.gmail.com")
         self.port = int(os.getenv("EMAIL_PORT", 587))
         self.user = os.getenv("EMAIL_USER")
         self.password = os.getenv("EMAIL_PASSWORD")
         self.alert_email = os.getenv("ALERT_EMAIL")
-        
+
         if not all([self.user, self.password, self.alert_email]):
             print("Warning: Notification credentials missing. Alerts will not be sent.")
 
+        # Seconds during which repeats of an alert are collected into one digest
+        self.alert_window = float(os.getenv("ALERT_WINDOW", 300))
+        self.rate_limit = TokenBucket(
+            float(os.getenv("ALERT_MAX_PER_HOUR", 12)) / 3600, float(os.getenv("ALERT_BURST", 3))
+        )
+        # The SMTP connection is closed after this many idle seconds (servers drop idle ones anyway)
+        self.smtp_idle_timeout = float(os.getenv("ALERT_SMTP_IDLE_TIMEOUT", 60))
+
+        self._queue = queue.Queue()
+        self._dispatch_stop = object()
+        self._smtp = None
+        self._last_used = None
+        # signature -> time its last alert or digest was sent
+        self._recent = {}
+        # signature -> collected repeats waiting for the digest
+        self._pending = {}
+        self._digest_due = None
+        self._thread = None
+        self._closed = False
+
+        if self.alert_email:
+            self._thread = threading.Thread(target=self._dispatch, name="alert-dispatcher", daemon=True)
+            self._thread.start()
+            # Alerts queued right before the process exits (e.g. a crash report) are still delivered
+            atexit.register(self.close)
+
     def send_error_alert(self, subject: str, error_message: str, context: str = ""):
         """
-        Sends an email alert about an error.
+        Queues an email alert about an error. Returns immediately.
         """
-        if not self.alert_email:
+        if not self.alert_email or self._closed:
+            return
+        self._queue.put((datetime.datetime.now(), subject, error_message, context))
+
+    def close(self, timeout: float = 30):
+        """Sends what is still queued or waiting for a digest, then closes the SMTP connection."""
+        if self._thread is None or self._closed:
             return
+        self._closed = True
+        self._queue.put(self._dispatch_stop)
+        self._thread.join(timeout=timeout)
+
+    def _dispatch(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self._next_wakeup())
+            except queue.Empty:
+                item = None
 
+            if item is self._dispatch_stop:
+                # Final digest, even when over the rate limit: nothing would send it later
+                if self._pending:
+                    self._send_digest(force=True)
+                self._close_smtp()
+                return
+            try:
+                if item is not None:
+                    self._accept(*item)
+                now = datetime.datetime.now()
+                if self._digest_due and now >= self._digest_due:
+                    self._send_digest()
+                if self._smtp and (now - self._last_used).total_seconds() >= self.smtp_idle_timeout:
+                    self._close_smtp()
+            except Exception as e:
+                # The dispatcher must survive anything, or later alerts would silently queue up
+                print(f"Alert dispatcher error: {e}")
+
+    def _next_wakeup(self):
+        """Seconds until the next digest is due or the SMTP connection goes idle; None to wait for alerts."""
+        deadlines = []
+        if self._digest_due:
+            deadlines.append(self._digest_due)
+        if self._smtp:
+            deadlines.append(self._last_used + datetime.timedelta(seconds=self.smtp_idle_timeout))
+        if not deadlines:
+            return None
+        return max((min(deadlines) - datetime.datetime.now()).total_seconds(), 0)
+
+    def _accept(self, when: datetime.datetime, subject: str, error_message: str, context: str):
+        signature = error_signature(error_message, context)
+        last_sent = self._recent.get(signature)
+        recently_sent = last_sent and (when - last_sent).total_seconds() < self.alert_window
+
+        if not recently_sent and signature not in self._pending and self.rate_limit.try_acquire():
+            self._recent[signature] = when
+            sent = self._deliver(self._build_alert(subject, error_message, context))
+            metrics.inc("invoice_alerts_total", outcome="sent" if sent else "failed")
+            return
+
+        # A repeat (or over the rate limit): collect it for the digest
+        entry = self._pending.get(signature)
+        if entry is None:
+            entry = self._pending[signature] = {
+                "context": context, "subject": subject, "error": error_message,
+                "count": 0, "first": when, "last": when,
+            }
+        entry["count"] += 1
+        entry["last"] = when
+        if self._digest_due is None:
+            self._digest_due = when + datetime.timedelta(seconds=self.alert_window)
+        metrics.inc("invoice_alerts_total", outcome="coalesced")
+
+    def _send_digest(self, force: bool = False):
+        if not force and not self.rate_limit.try_acquire():
+            # Over the limit; keep collecting and try again after another window
+            self._digest_due = datetime.datetime.now() + datetime.timedelta(seconds=self.alert_window)
+            return
+
+        pending, self._pending, self._digest_due = self._pending, {}, None
+        now = datetime.datetime.now()
+        for signature in pending:
+            self._recent[signature] = now
+        sent = self._deliver(self._build_digest(pending))
+        metrics.inc("invoice_alerts_total", outcome="digest" if sent else "failed")
+
+    def _build_alert(self, subject: str, error_message: str, context: str) -> MIMEMultipart:
+        msg = MIMEMultipart()
+        msg['From'] = self.user
+        msg['To'] = self.alert_email
+        msg['Subject'] = f"⚠️ Invoice Automation Error: {subject}"
+
+        body = f"""
+        <h2>Invoice Processing Error</h2>
+        <p><strong>Context:</strong> {context}</p>
+        <p><strong>Error Details:</strong></p>
+        <pre>{error_message}</pre>
+        <p>Please check the system logs for more information.</p>
+        """
+
+        msg.attach(MIMEText(body, 'html'))
+        return msg
+
+    def _build_digest(self, pending: dict) -> MIMEMultipart:
+        total = sum(entry["count"] for entry in pending.values())
+        msg = MIMEMultipart()
+        msg['From'] = self.user
+        msg['To'] = self.alert_email
+        msg['Subject'] = f"⚠️ Invoice Automation: {total} more error(s) of {len(pending)} kind(s)"
+
+        sections = []
+        for entry in sorted(pending.values(), key=lambda entry: -entry["count"]):
+            sections.append(f"""
+            <h3>{entry['count']}× {html.escape(entry['context'] or 'Error')}</h3>
+            <p><strong>Between:</strong> {entry['first']:%Y-%m-%d %H:%M:%S} and {entry['last']:%Y-%m-%d %H:%M:%S}</p>
+            <p><strong>Example:</strong> {html.escape(entry['subject'])}</p>
+            <pre>{html.escape(entry['error'])}</pre>
+            """)
+        body = f"""
+        <h2>Invoice Processing Errors</h2>
+        <p>These errors repeated after their first alert, or arrived while alerts were rate limited.</p>
+        {''.join(sections)}
+        <p>Please check the system logs for more information.</p>
+        """
+
+        msg.attach(MIMEText(body, 'html'))
+        return msg
+
+    def _deliver(self, msg) -> bool:
+        """Sends over the persistent connection, reconnecting once if the server dropped it."""
+        for attempt in range(2):
+            try:
+                if self._smtp is None:
+                    self._smtp = self._connect()
+                self._smtp.send_message(msg)
+                self._last_used = datetime.datetime.now()
+                print(f"Error alert sent to {self.alert_email}")
+                return True
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as e:
+                # Rejected by the server (login, sender, recipients); sending again would not help
+                self._close_smtp()
+                print(f"Failed to send error alert: {e}")
+                return False
+            except OSError as e:
+                # Dropped or unreachable connection (SMTPServerDisconnected included)
+                self._close_smtp()
+                if attempt:
+                    print(f"Failed to send error alert: {e}")
+        return False
+
+    def _connect(self) -> smtplib.SMTP:
+        if self.port == 465:
+            # Use SSL
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=30)
+        else:
+            # Use STARTTLS (default for 587)
+            server = smtplib.SMTP(self.host, self.port, timeout=30)
+            server.starttls()
+        server.login(self.user, self.password)
+        self._last_used = datetime.datetime.now()
+        return server
+
+    def _close_smtp(self):
+        server, self._smtp = self._smtp, None
+        if server is None:
+            return
         try:
-            msg = MIMEMultipart()
-            msg['From'] = self.user
-            msg['To'] = self.alert_email
-            msg['Subject'] = f"⚠️ Invoice Automation Error: {subject}"
-
-            body = f"""
-            <h2>Invoice Processing Error</h2>
-            <p><strong>Context:</strong> {context}</p>
-            <p><strong>Error Details:</strong></p>
-            <pre>{error_message}</pre>
-            <p>Please check the system logs for more information.</p>
-            """
-            
-            msg.attach(MIMEText(body, 'html'))
-
-            if self.port == 465:
-                # Use SSL
-                with smtplib.SMTP_SSL(self.host, self.port) as server:
-                    server.login(self.user, self.password)
-                    server.send_message(msg)
-            else:
-                # Use STARTTLS (default for 587)
-                with smtplib.SMTP(self.host, self.port) as server:
-                    server.starttls()
-                    server.login(self.user, self.password)
-                    server.send_message(msg)
-                
-            print(f"Error alert sent to {self.alert_email}")
-            
-        except Exception as e:
-            print(f"Failed to send error alert: {e}")
+            server.quit()
+        except Exception:
+            # Already disconnected
+            pass
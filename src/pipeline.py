@@ -0,0 +1,176 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Iterator, List, Optional, Tuple
+from src import metrics
+from src.dedupe_index import file_sha256
+from src.extraction_executor import ExtractionExecutor, ExtractionResult
+
+
+def _resolved(value) -> Future:
+    """An already completed future, for stages restored from the journal."""
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+class InvoicePipeline:
+    """
+    Runs the per-PDF stages (Drive upload, extraction, Sheets append) concurrently.
+    Network-bound stages use thread pools, extraction runs in ExtractionExecutor's worker processes.
+
+    Emails are processed as a unit: an email counts as finished only when every one of
+    its PDFs went through all stages. Completed emails are handed back to the caller's
+    thread via completed(), so IMAP flagging and alerting stay on the thread that owns
+    the mailbox connection.
+    """
+
+    def __init__(self, drive_service, extraction_service, sheets_service, dedupe_index=None, journal=None, extraction_cache=None):
+        self.drive_service = drive_service
+        self.extraction_service = extraction_service
+        self.sheets_service = sheets_service
+        # Optional DedupeIndex: PDFs already processed end to end are skipped
+        self.dedupe_index = dedupe_index
+        # Optional JobJournal: per-PDF stage progress, so a restarted process resumes instead of redoing work
+        self.journal = journal
+
+        self.upload_workers = int(os.getenv("PIPELINE_UPLOAD_WORKERS", 4))
+        self.extract_workers = int(os.getenv("PIPELINE_EXTRACT_WORKERS", os.cpu_count() or 1))
+        self.sheets_workers = int(os.getenv("PIPELINE_SHEETS_WORKERS", 2))
+        # Emails processed at the same time; fetching pauses while this many are in flight
+        self.max_in_flight = int(os.getenv("PIPELINE_MAX_EMAILS", 8))
+
+        self._email_pool = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="email")
+        self._upload_pool = ThreadPoolExecutor(max_workers=self.upload_workers, thread_name_prefix="upload")
+        self._sheets_pool = ThreadPoolExecutor(max_workers=self.sheets_workers, thread_name_prefix="sheets")
+        # Optional ExtractionCache: re-sent and retried PDFs are not parsed again
+        self._extractor = ExtractionExecutor(extraction_service, workers=self.extract_workers, cache=extraction_cache)
+
+        self._in_flight: List[Tuple[object, Future]] = []
+
+    def submit(self, msg, pdf_paths: List[str]):
+        """Starts processing all PDFs of an email in the background."""
+        future = self._email_pool.submit(self._process_email, msg, pdf_paths)
+        self._in_flight.append((msg, future))
+
+    def completed(self, wait_all: bool = False) -> Iterator[Tuple[object, Optional[BaseException]]]:
+        """
+        Yields (msg, error) for every email whose pipeline has finished; error is None on success.
+        Blocks only while max_in_flight emails are being processed, or, with wait_all=True,
+        until every submitted email has finished.
+        """
+        while self._in_flight:
+            done = [item for item in self._in_flight if item[1].done()]
+
+            if not done:
+                if not wait_all and len(self._in_flight) < self.max_in_flight:
+                    return
+                wait([future for _, future in self._in_flight], return_when=FIRST_COMPLETED)
+                continue
+
+            for item in done:
+                self._in_flight.remove(item)
+                msg, future = item
+                yield msg, future.exception()
+
+    def shutdown(self):
+        for pool in (self._email_pool, self._upload_pool, self._sheets_pool):
+            pool.shutdown(wait=True)
+        self._extractor.shutdown()
+
+    def _process_email(self, msg, pdf_paths: List[str]):
+        pdf_paths, digests = self._skip_known(msg.uid, pdf_paths)
+
+        # Upload and extraction do not depend on each other, so both start right away.
+        # Stages completed before a restart are taken from the journal instead of being redone.
+        uploads, extractions, jobs = [], [], []
+        for pdf_path in pdf_paths:
+            job = self.journal.get(msg.uid, digests[pdf_path]) if self.journal else None
+            if job is None and self.journal:
+                self.journal.record(msg.uid, digests[pdf_path], "downloaded", path=pdf_path)
+            jobs.append(job or {})
+
+            if job and job.get("file_url"):
+                uploads.append(_resolved(job["file_url"]))
+            else:
+                uploads.append(self._upload_pool.submit(self._upload, msg.uid, digests[pdf_path], pdf_path))
+
+            if job and "data" in job:
+                extractions.append(_resolved(ExtractionResult("ok", job["data"], 0.0, None)))
+            else:
+                extractions.append(self._extractor.submit(pdf_path, sender=msg.from_, digest=digests[pdf_path]))
+        records = []
+
+        try:
+            for pdf_path, upload, extraction, job in zip(pdf_paths, uploads, extractions, jobs):
+                print(f"  Processing file: {pdf_path}")
+
+                # 1. Upload to Drive
+                file_url = upload.result()
+                if not file_url:
+                    raise Exception("Failed to upload to Drive")
+
+                # 2. Extract Data
+                result = extraction.result()
+                data = dict(result.data)
+                if result.status != "ok":
+                    # Keep the invoice: the row is recorded with the reason so it can be filled in by hand
+                    data['comment'] = f"Automatic extraction failed ({result.status}): {result.error}"
+                    self.sheets_service.log("WARNING", f"Extraction {result.status} for {pdf_path}: {result.error}", context="Extraction")
+                if self.journal and "data" not in job:
+                    self.journal.record(msg.uid, digests[pdf_path], "extracted", data=data)
+                data['file_url'] = file_url
+                print(f"    Extracted: {data}")
+
+                # 3. Add to Sheets (formerly Notion)
+                records.append(self._sheets_pool.submit(self._record_invoice, data, msg.uid, digests[pdf_path]))
+
+            for record in records:
+                record.result()
+        except Exception:
+            # The email failed as a whole; don't spend more time on its other PDFs
+            for future in uploads + extractions + records:
+                future.cancel()
+            raise
+
+    def _upload(self, uid: str, digest: str, pdf_path: str) -> Optional[str]:
+        file_url = self.drive_service.upload_file(pdf_path)
+        if file_url and self.journal:
+            self.journal.record(uid, digest, "uploaded", file_url=file_url)
+        return file_url
+
+    def _skip_known(self, uid: str, pdf_paths: List[str]):
+        """
+        Drops PDFs whose bytes were already processed end to end (reminders, forwarded
+        copies, retries of a partly processed email) and repeats within the same email.
+        Returns the remaining paths and their SHA-256 digests.
+        """
+        remaining, digests = [], {}
+        for pdf_path in pdf_paths:
+            digest = file_sha256(pdf_path)
+            if digest in digests.values():
+                continue
+            job = self.journal.get(uid, digest) if self.journal else None
+            if job and job.get("stage") in ("recorded", "flagged"):
+                print(f"  Already recorded before restart: {pdf_path}")
+                continue
+            cached = self.dedupe_index.lookup(digest) if self.dedupe_index else None
+            if cached:
+                print(f"  Skipping already processed file: {pdf_path} ({cached['file_url']})")
+                self.sheets_service.log("INFO", f"Duplicate invoice skipped: {cached['data'].get('vendor')} - {cached['data'].get('amount')} ({cached['file_url']})", context="Dedupe")
+                continue
+            remaining.append(pdf_path)
+            digests[pdf_path] = digest
+        return remaining, digests
+
+    def _record_invoice(self, data: dict, uid: str, digest: str):
+        added = self.sheets_service.add_invoice(data)
+        metrics.inc("invoice_documents_total", stage="recorded" if added is not False else "duplicate_row")
+        if self.journal:
+            self.journal.record(uid, digest, "recorded")
+        if added is False:
+            self.sheets_service.log("INFO", f"Invoice already in Sheets, row not added: {data.get('invoice_number')} - {data.get('vendor')}", context="Dedupe")
+        else:
+            self.sheets_service.log("INFO", f"Successfully processed invoice: {data.get('vendor')} - {data.get('amount')}", context="Invoice Success")
+        # Only fully recorded invoices count as known
+        if self.dedupe_index:
+            self.dedupe_index.record(digest, data.get('file_url'), data)
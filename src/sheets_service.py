@@ -1,16 +1,32 @@
 import os
 import json
+import time
+import queue
+import atexit
+import random
+import threading
+import httplib2
 import datetime
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from collections import deque
+from googleapiclient.errors import HttpError
+from typing import Tuple
+from src import metrics
+from src.dedupe_index import state_dir
+from src.google_clients import RETRYABLE_STATUSES, build_service, load_credentials
 
-class SheetsService:
-    SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+INVOICE_RANGE = "A:I"
+LOG_RANGE = "log!A:D"
+# Invoice number (B) and vendor tax id (D) columns, read for the duplicate index
+INDEX_COLUMNS = ("B", "D")
+
+# Log levels that may be dropped when the log queue is full; everything else is always kept
+DROPPABLE_LEVELS = ("DEBUG", "INFO")
 
+class SheetsService:
     def __init__(self):
-        self.service_account_info = os.getenv("GOOGLE_SERVICE_ACCOUNT_FILE")
-        self.service_account_json = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
         self.spreadsheet_id = os.getenv("GOOGLE_SHEET_ID")
+        # Called with [(row, error message)] when Sheets refuses invoice rows for good (e.g. an alert)
+        self.on_rejected = None
         
         if not self.spreadsheet_id:
             print("Warning: GOOGLE_SHEET_ID not set. Logging to Sheets disabled.")
@@ -18,60 +34,168 @@ class SheetsService:
             return
 
         try:
-            creds = None
-            
-            # 1. Try GOOGLE_SERVICE_ACCOUNT_JSON (Priority)
-            if self.service_account_json:
-                try:
-                    info = json.loads(self.service_account_json)
-                    creds = service_account.Credentials.from_service_account_info(
-                        info, scopes=self.SCOPES
-                    )
-                except json.JSONDecodeError:
-                    pass
-
-            # 2. Try GOOGLE_SERVICE_ACCOUNT_FILE (Fallback)
-            if not creds and self.service_account_info:
-                # First, try to treat it as a file path
-                if os.path.exists(self.service_account_info):
-                    creds = service_account.Credentials.from_service_account_file(
-                        self.service_account_info, scopes=self.SCOPES
-                    )
-                else:
-                    # If file doesn't exist, try to parse the variable content as JSON
-                    try:
-                        # Clean the string
-                        clean_info = self.service_account_info.strip().strip("'").strip('"')
-                        info = json.loads(clean_info)
-                        creds = service_account.Credentials.from_service_account_info(
-                            info, scopes=self.SCOPES
-                        )
-                    except json.JSONDecodeError:
-                        pass
-
-            if not creds:
-                 print("Warning: Could not authenticate SheetsService (no valid creds found).")
-                 self.service = None
-                 return
-
-            self.creds = creds
-            self.service = build('sheets', 'v4', credentials=self.creds)
+            # Credentials, transport and discovery are shared with DriveService
+            if load_credentials() is None:
+                print("Warning: Could not authenticate SheetsService (no valid creds found).")
+                self.service = None
+                return
+            self.service = build_service('sheets', 'v4')
         except Exception as e:
             print(f"Error initializing SheetsService: {e}")
             self.service = None
+            return
+
+        self._init_write_buffer()
+        self._init_logger()
+        self._init_invoice_index()
+
+    def _init_write_buffer(self):
+        """
+        Rows are buffered per range and written with one values.append per range.
+        A flush happens when flush_rows rows are pending, every flush_interval seconds,
+        at the end of each cycle (flush()) and at shutdown (close()).
+        Pending invoice rows are mirrored to a spill file so they survive a crash or a
+        failed final flush, and are re-queued on the next start. Rows the API refuses for
+        good (400 bad value, 403, ...) are not retried: they go to the rejected file, to be
+        fixed and added by hand, so one bad row never blocks the ones after it.
+        """
+        self.flush_rows = int(os.getenv("SHEETS_FLUSH_ROWS", 50))
+        self.flush_interval = float(os.getenv("SHEETS_FLUSH_INTERVAL", 10))
+        self.max_retries = int(os.getenv("SHEETS_MAX_RETRIES", 5))
+        self.spill_path = os.getenv("SHEETS_SPILL_PATH", os.path.join(state_dir(), "sheets_pending.jsonl"))
+        self.rejected_path = os.getenv("SHEETS_REJECTED_PATH", os.path.join(state_dir(), "sheets_rejected.jsonl"))
+
+        self._buffer = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+
+        self._load_spill()
+
+        self._flusher = threading.Thread(target=self._flush_periodically, name="sheets-flush", daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def _init_logger(self):
+        """
+        log() only enqueues; a background thread moves entries into the write buffer.
+        When the queue is full, DEBUG/INFO entries are dropped while ERROR/CRITICAL (and
+        anything else) go to an overflow list that is never dropped.
+        """
+        self._log_queue = queue.Queue(maxsize=int(os.getenv("SHEETS_LOG_QUEUE_SIZE", 1000)))
+        self._log_overflow = deque()
+        self._log_counters = {"queued": 0, "flushed": 0, "dropped": 0}
+        self._counter_lock = threading.Lock()
+        self._log_stop = object()
+
+        self._log_thread = threading.Thread(target=self._drain_log_queue, name="sheets-log", daemon=True)
+        self._log_thread.start()
 
     def log(self, level: str, message: str, context: str = ""):
         """
         Appends a log entry to the configured Google Sheet (Log sheet).
         Columns: Timestamp, Level, Message, Context
+        Non-blocking: the entry is queued and written by a background thread.
         """
         if not self.service:
             return
 
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        values = [[timestamp, level, message, context]]
-        
-        self._append_row("log!A:D", values)
+        entry = (time.time(), level, message, context)
+        try:
+            self._log_queue.put_nowait(entry)
+        except queue.Full:
+            if level.upper() in DROPPABLE_LEVELS:
+                self._count("dropped")
+                return
+            self._log_overflow.append(entry)
+        self._count("queued")
+
+    def log_counters(self) -> dict:
+        """Counts of log entries queued, written to Sheets and dropped since startup."""
+        with self._counter_lock:
+            return dict(self._log_counters)
+
+    def _count(self, name: str, amount: int = 1):
+        with self._counter_lock:
+            self._log_counters[name] += amount
+
+    def _drain_log_queue(self):
+        while True:
+            entries = [self._log_queue.get()]
+            # Take whatever else is already waiting so it lands in the buffer in one go
+            while True:
+                try:
+                    entries.append(self._log_queue.get_nowait())
+                except queue.Empty:
+                    break
+            while self._log_overflow:
+                entries.append(self._log_overflow.popleft())
+
+            stop = self._log_stop in entries
+            rows = [
+                [datetime.datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S"), level, message, context]
+                for ts, level, message, context in (e for e in entries if e is not self._log_stop)
+            ]
+            if rows:
+                self._append_row(LOG_RANGE, rows)
+            if stop:
+                return
+
+    def _init_invoice_index(self):
+        """
+        Hash index of the (invoice number, vendor tax id) pairs in the sheet, so add_invoice
+        can skip duplicates without reading the sheet. Re-read in full (columns B:D, one
+        ranged read) at the start of every cycle, so rows deleted or edited by hand anywhere
+        in the sheet are reflected before the next invoice is added.
+        """
+        self._index_lock = threading.Lock()
+        self._invoice_index = set()
+        self.refresh_invoice_index()
+
+    @staticmethod
+    def _invoice_key(invoice_number, vendor_tax_id):
+        """
+        Duplicate key of an invoice, or None when it cannot be told apart from other vendors'
+        invoices: numbers like "2024/001" are common, so a number alone is not a duplicate.
+        """
+        number = str(invoice_number or "").strip().upper()
+        tax_id = str(vendor_tax_id or "").strip()
+        if not number or not tax_id:
+            return None
+        return number, tax_id
+
+    def refresh_invoice_index(self):
+        """Re-reads the duplicate index from the sheet (call once per cycle)."""
+        if not self.service:
+            return
+        first, last = INDEX_COLUMNS
+        try:
+            # A flush in progress has taken its rows out of the buffer but may not have written them yet
+            with self._flush_lock, metrics.timer("sheets_index"):
+                rows = self._get_values(f"{first}:{last}")
+                with self._index_lock:
+                    self._rebuild_index(rows)
+        except Exception as e:
+            print(f"Failed to refresh invoice index from Sheets: {e}")
+
+    def _rebuild_index(self, rows: list):
+        # Rows read from B:D: [invoice number, vendor name, vendor tax id]
+        index = {
+            self._invoice_key(row[0] if len(row) > 0 else "", row[2] if len(row) > 2 else "")
+            for row in rows
+        }
+        # Rows still waiting in the write buffer are part of the sheet as far as duplicates go
+        with self._lock:
+            pending = list(self._buffer.get(INVOICE_RANGE, []))
+        index.update(self._invoice_key(row[1], row[3]) for row in pending)
+        index.discard(None)
+        self._invoice_index = index
+
+    def _get_values(self, range_name: str) -> list:
+        response = self.service.spreadsheets().values().get(
+            spreadsheetId=self.spreadsheet_id, range=range_name
+        ).execute()
+        return response.get('values', [])
 
     def add_invoice(self, data: dict):
         """
@@ -86,10 +210,19 @@ class SheetsService:
         7. Bruttó összeg
         8. Megjegyzés / Közlemény
         9. Vevő neve
+        Returns False (and appends nothing) if the invoice number of this vendor is already in the sheet.
         """
         if not self.service:
             return
 
+        key = self._invoice_key(data.get('invoice_number'), data.get('vendor_tax_id'))
+        if key:
+            with self._index_lock:
+                if key in self._invoice_index:
+                    print(f"Invoice {key[0]} ({key[1]}) already in Sheets, skipping.")
+                    return False
+                self._invoice_index.add(key)
+
         values = [[
             data.get('type', ''),
             data.get('invoice_number', ''),
@@ -105,16 +238,179 @@ class SheetsService:
         # Append to the first sheet (or specific sheet if named)
         # Assuming the main sheet is the first one or named 'Munkalap1' or similar.
         # We'll use "A:I" which usually appends to the first sheet's first empty row.
-        self._append_row("A:I", values)
+        self._append_row(INVOICE_RANGE, values)
+        return True
 
     def _append_row(self, range_name: str, values: list):
+        """Queues rows for range_name; they are written by the next flush."""
+        with self._lock:
+            self._buffer.setdefault(range_name, []).extend(values)
+            if range_name == INVOICE_RANGE:
+                self._spill(range_name, values)
+            pending = sum(len(rows) for rows in self._buffer.values())
+            
+        if pending >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered rows, one values.append call per range."""
+        if not self.service:
+            return
+            
+        with self._flush_lock:
+            with self._lock:
+                batches, self._buffer = self._buffer, {}
+            if not batches:
+                return
+                
+            failed = {}
+            rejected = []
+            for range_name, rows in batches.items():
+                if range_name == INVOICE_RANGE:
+                    retry, refused = self._write_invoice_rows(rows)
+                    if retry:
+                        failed[range_name] = retry
+                    rejected.extend(refused)
+                    continue
+                try:
+                    self._append_with_retry(range_name, rows)
+                    written = True
+                except Exception:
+                    written = False
+                if range_name == LOG_RANGE:
+                    self._count("flushed" if written else "dropped", len(rows))
+
+            with self._lock:
+                # Invoice rows that may still go through are never dropped; log rows are, to keep an
+                # outage from growing the buffer forever
+                for range_name, rows in failed.items():
+                    self._buffer[range_name] = rows + self._buffer.get(range_name, [])
+                if INVOICE_RANGE in batches:
+                    self._rewrite_spill()
+
+        if rejected:
+            self._reject(rejected)
+
+    def _write_invoice_rows(self, rows: list) -> Tuple[list, list]:
+        """
+        Appends invoice rows. Returns (rows to retry later, [(row, error)] refused for good).
+        A batch refused with 400 (typically one bad value) is split into single rows, so only
+        the bad row is refused.
+        """
         try:
-            body = {'values': values}
-            self.service.spreadsheets().values().append(
-                spreadsheetId=self.spreadsheet_id,
-                range=range_name,
-                valueInputOption="USER_ENTERED",
-                body=body
-            ).execute()
+            self._append_with_retry(INVOICE_RANGE, rows)
+            return [], []
         except Exception as e:
-            print(f"Failed to append to Sheets ({range_name}): {e}")
+            if self._is_retryable(e):
+                return rows, []
+            if len(rows) == 1 or not (isinstance(e, HttpError) and e.resp.status == 400):
+                return [], [(row, str(e)) for row in rows]
+
+        retry, refused = [], []
+        for row in rows:
+            row_retry, row_refused = self._write_invoice_rows([row])
+            retry.extend(row_retry)
+            refused.extend(row_refused)
+        return retry, refused
+
+    def _reject(self, rejected: list):
+        """Moves refused invoice rows to the rejected file and reports them."""
+        try:
+            directory = os.path.dirname(self.rejected_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.rejected_path, "a", encoding="utf-8") as f:
+                for row, error in rejected:
+                    f.write(json.dumps({"range": INVOICE_RANGE, "values": [row], "error": error}, ensure_ascii=False, default=str) + "\n")
+        except OSError as e:
+            print(f"Warning: could not save rejected Sheets rows: {e}")
+        message = f"Sheets refused {len(rejected)} invoice row(s), saved to {self.rejected_path}: {rejected[0][1]}"
+        print(message)
+        self.log("ERROR", message, context="Sheets Flush")
+        if self.on_rejected:
+            self.on_rejected(rejected)
+
+    def close(self):
+        """Stops the background threads and writes whatever is still buffered."""
+        if not self.service or self._closed.is_set():
+            return
+        self._closed.set()
+        # Move queued log entries into the buffer first so they are part of the final flush
+        self._log_queue.put(self._log_stop)
+        self._log_thread.join(timeout=10)
+        self.flush()
+        pending = len(self._buffer.get(INVOICE_RANGE, []))
+        if pending:
+            print(f"Warning: {pending} invoice row(s) could not be written to Sheets; kept in {self.spill_path}")
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval):
+            if self._buffer:
+                self.flush()
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        if isinstance(error, HttpError):
+            return error.resp.status in RETRYABLE_STATUSES
+        return isinstance(error, (OSError, httplib2.HttpLib2Error))
+
+    def _append_with_retry(self, range_name: str, rows: list) -> dict:
+        """Appends rows, retrying quota and server errors. Returns the API response; raises the last error on failure."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                with metrics.timer("sheets_append"):
+                    return self.service.spreadsheets().values().append(
+                        spreadsheetId=self.spreadsheet_id,
+                        range=range_name,
+                        valueInputOption="USER_ENTERED",
+                        body={'values': rows}
+                    ).execute()
+            except Exception as e:
+                if not self._is_retryable(e) or attempt == self.max_retries:
+                    print(f"Failed to append to Sheets ({range_name}): {e}")
+                    metrics.inc("invoice_api_errors_total", api="sheets")
+                    raise
+
+            metrics.inc("invoice_api_retries_total", api="sheets")
+            # Exponential backoff with jitter, capped at one minute
+            time.sleep(min(2 ** attempt, 60) * random.uniform(0.5, 1.5))
+
+    def _spill(self, range_name: str, values: list):
+        try:
+            directory = os.path.dirname(self.spill_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"range": range_name, "values": values}, ensure_ascii=False, default=str) + "\n")
+        except OSError as e:
+            print(f"Warning: could not persist pending Sheets rows: {e}")
+
+    def _rewrite_spill(self):
+        """Replaces the spill file with the invoice rows that are still pending."""
+        rows = self._buffer.get(INVOICE_RANGE, [])
+        try:
+            if not rows:
+                if os.path.exists(self.spill_path):
+                    os.remove(self.spill_path)
+                return
+            tmp_path = self.spill_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(json.dumps({"range": INVOICE_RANGE, "values": rows}, ensure_ascii=False, default=str) + "\n")
+            os.replace(tmp_path, self.spill_path)
+        except OSError as e:
+            print(f"Warning: could not persist pending Sheets rows: {e}")
+
+    def _load_spill(self):
+        """Re-queues invoice rows left over from a previous run."""
+        if not os.path.exists(self.spill_path):
+            return
+        with open(self.spill_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self._buffer.setdefault(entry["range"], []).extend(entry["values"])
+        pending = sum(len(rows) for rows in self._buffer.values())
+        if pending:
+            print(f"Re-queued {pending} pending Sheets row(s) from the previous run.")
@@ -0,0 +1,188 @@
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+# File in the spool root naming the source (account, folder, UIDVALIDITY) of the kept UIDs
+SOURCE_MARKER = ".source"
+
+
+class Spool:
+    """
+    Managed download area for the PDFs of in-flight emails.
+
+    Every message gets its own directory (named by UID), so equally named attachments of
+    different emails never collide. UIDs only identify an email within one mailbox folder
+    and UIDVALIDITY, so the spool is bound to that source (bind()) and drops every kept
+    directory when it changes. An email's directory is deleted once its pipeline
+    succeeded; after a failure it is kept, so the retry in the next cycle reuses the files
+    instead of downloading them again. Kept directories (and leftovers of earlier runs) are
+    evicted least recently used first whenever the spool grows beyond max_bytes; directories
+    of emails still in flight are never evicted.
+
+    With memory_dir set (a tmpfs such as /dev/shm), files up to memory_max_file bytes are
+    spooled there, so small PDFs never touch the disk before upload and extraction.
+    """
+
+    def __init__(self, root: str = None):
+        self.root = root or os.getenv("SPOOL_DIR", "downloads")
+        self.max_bytes = int(os.getenv("SPOOL_MAX_BYTES", 512 * 1024 * 1024))
+        self.memory_dir = os.getenv("SPOOL_MEMORY_DIR") or None
+        self.memory_max_file = int(os.getenv("SPOOL_MEMORY_MAX_FILE", 2 * 1024 * 1024))
+
+        self._lock = threading.Lock()
+        # uid -> bytes spooled, least recently used first
+        self._entries = OrderedDict()
+        self._active = set()
+        self._total = 0
+
+        for root in self._roots():
+            os.makedirs(root, exist_ok=True)
+        self._scan()
+
+    def bind(self, source: str):
+        """
+        Ties the kept files to the source their UIDs belong to (account, folder and
+        UIDVALIDITY). On a different source than the previous one, including the first bind
+        after files of unknown origin were found, every directory not in flight is removed.
+        """
+        marker = os.path.join(self.root, SOURCE_MARKER)
+        try:
+            with open(marker, encoding="utf-8") as f:
+                previous = f.read()
+        except OSError:
+            previous = None
+        if previous == source:
+            return
+
+        with self._lock:
+            stale = [uid for uid in self._entries if uid not in self._active]
+            for uid in stale:
+                self._total -= self._entries.pop(uid)
+        if stale:
+            print(f"Spool: mailbox source changed, dropping kept files of {len(stale)} message(s)")
+        for uid in stale:
+            self._remove(uid)
+        with open(marker, "w", encoding="utf-8") as f:
+            f.write(source)
+
+    def find(self, uid: str, name: str) -> Optional[str]:
+        """Path of a complete file kept from an earlier attempt, or None."""
+        for root in self._roots():
+            path = os.path.join(root, str(uid), name)
+            if os.path.exists(path):
+                self._touch(uid)
+                return path
+        return None
+
+    def write(self, uid: str, name: str, chunks: Iterable[bytes], size_hint: int = None) -> str:
+        """
+        Writes a file into the message's directory. The data goes to a temporary name first,
+        so a file under its final name is always complete.
+        """
+        path = os.path.join(self._message_dir(uid, size_hint), name)
+        tmp_path = path + ".part"
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.add(uid, path)
+        return path
+
+    def create(self, uid: str, name: str, size_hint: int = None):
+        """
+        Opens a new file in the message's directory for the caller to write, adding -1, -2, ...
+        to the name if it is taken. Returns (path, file); call add() once it is complete.
+        """
+        directory = self._message_dir(uid, size_hint)
+        stem, ext = os.path.splitext(name)
+        counter = 0
+        while True:
+            path = os.path.join(directory, name if not counter else f"{stem}-{counter}{ext}")
+            try:
+                # Exclusive create: concurrent writers can never open the same file
+                return path, open(path, "xb")
+            except FileExistsError:
+                counter += 1
+
+    def add(self, uid: str, path: str):
+        """Accounts a completed file and evicts kept directories if the spool is over max_bytes."""
+        size = os.path.getsize(path)
+        with self._lock:
+            self._entries[str(uid)] = self._entries.get(str(uid), 0) + size
+            self._entries.move_to_end(str(uid))
+            self._total += size
+        self._evict()
+
+    def release(self, uid: str, keep: bool = False):
+        """
+        Called when an email's pipeline finished. Its directory is deleted, or with keep=True
+        (the email will be retried) left for reuse until it is evicted.
+        """
+        uid = str(uid)
+        with self._lock:
+            self._active.discard(uid)
+            if keep:
+                return
+            self._total -= self._entries.pop(uid, 0)
+        self._remove(uid)
+
+    def _message_dir(self, uid: str, size_hint: int = None) -> str:
+        uid = str(uid)
+        small = self.memory_dir and size_hint is not None and size_hint <= self.memory_max_file
+        directory = os.path.join(self.memory_dir if small else self.root, uid)
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self._active.add(uid)
+            self._entries.setdefault(uid, 0)
+            self._entries.move_to_end(uid)
+        return directory
+
+    def _touch(self, uid: str):
+        with self._lock:
+            self._active.add(str(uid))
+            if str(uid) in self._entries:
+                self._entries.move_to_end(str(uid))
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._total <= self.max_bytes:
+                    return
+                victim = next((uid for uid in self._entries if uid not in self._active), None)
+                if victim is None:
+                    # Everything left belongs to emails in flight
+                    return
+                self._total -= self._entries.pop(victim)
+            print(f"Spool over {self.max_bytes} bytes, evicting kept files of message {victim}")
+            self._remove(victim)
+
+    def _remove(self, uid: str):
+        for root in self._roots():
+            shutil.rmtree(os.path.join(root, uid), ignore_errors=True)
+
+    def _roots(self):
+        return [self.root] + ([self.memory_dir] if self.memory_dir else [])
+
+    def _scan(self):
+        """Picks up directories left by earlier runs, oldest first, as evictable entries."""
+        found = {}
+        for root in self._roots():
+            for entry in os.scandir(root):
+                if entry.is_dir():
+                    size = sum(
+                        os.path.getsize(os.path.join(dirpath, name))
+                        for dirpath, _, names in os.walk(entry.path) for name in names
+                    )
+                    mtime = entry.stat().st_mtime
+                    previous = found.get(entry.name, (0, mtime))
+                    found[entry.name] = (previous[0] + size, min(previous[1], mtime))
+        for uid, (size, _) in sorted(found.items(), key=lambda item: item[1][1]):
+            self._entries[uid] = size
+            self._total += size
@@ -0,0 +1,50 @@
+import os
+import sqlite3
+import threading
+from typing import Tuple
+
+
+class SqliteStore:
+    """
+    Base of the SQLite-backed stores (dedupe index, extraction cache, backfill checkpoint).
+
+    One WAL-mode connection is shared by the caller's threads, serialised with a lock.
+    Subclasses list their CREATE statements in schema, set their own limits before calling
+    __init__ and override evict(), which runs at startup and after every evict_every writes
+    so long-running processes stay bounded too.
+    """
+    schema: Tuple[str, ...] = ()
+    evict_every = 500
+
+    def __init__(self, path: str, timeout: float = 5.0):
+        self.path = path
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=timeout, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        for statement in self.schema:
+            self._conn.execute(statement)
+        self._conn.commit()
+        self._writes = 0
+        self.evict()
+
+    def _write(self, sql: str, params: tuple = ()):
+        """Runs and commits one write; evicts every evict_every writes."""
+        with self._lock:
+            self._conn.execute(sql, params)
+            self._conn.commit()
+            self._writes += 1
+            evict = self.evict_every and self._writes % self.evict_every == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Drops expired entries; stores without limits keep everything."""
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,121 @@
+import os
+import re
+import json
+import hashlib
+from typing import Dict, Optional
+
+# Fields a template may define patterns for
+TEMPLATE_FIELDS = ("invoice_number", "issue_date", "due_date", "amount", "buyer")
+
+
+class FieldRule:
+    """
+    One precompiled pattern, scoped to a page ("first", "last", "any" or a 0-based index)
+    and optionally to the region of the page text between two literal markers.
+    """
+
+    def __init__(self, spec: dict):
+        self.pattern = re.compile(spec["pattern"], re.MULTILINE)
+        self.page = spec.get("page", "any")
+        self.after = (spec.get("after") or "").lower()
+        self.before = (spec.get("before") or "").lower()
+
+    def applies_to(self, index: int, page_count: int) -> bool:
+        if self.page == "any":
+            return True
+        if self.page == "first":
+            return index == 0
+        if self.page == "last":
+            return index == page_count - 1
+        return index == int(self.page)
+
+    def search(self, text: str) -> Optional[tuple]:
+        """The match's groups (or the whole match when it has none), or None."""
+        start, end = 0, len(text)
+        if self.after or self.before:
+            lowered = text.lower()
+            if self.after:
+                position = lowered.find(self.after)
+                if position < 0:
+                    return None
+                start = position + len(self.after)
+            if self.before:
+                position = lowered.find(self.before, start)
+                if position >= 0:
+                    end = position
+
+        match = self.pattern.search(text, start, end)
+        if not match:
+            return None
+        return match.groups() or (match.group(0),)
+
+
+class VendorTemplate:
+    """Extraction rules of one recurring vendor, identified by tax id and/or sender domain."""
+
+    def __init__(self, spec: dict):
+        self.name = spec["name"]
+        self.vendor = spec.get("vendor", self.name)
+        self.tax_ids = spec.get("tax_ids", [])
+        self.sender_domains = [domain.lower() for domain in spec.get("sender_domains", [])]
+        self.rules = {
+            field: FieldRule(rule) for field, rule in spec.get("fields", {}).items()
+            if field in TEMPLATE_FIELDS
+        }
+
+    def extract(self, text: str, index: int, page_count: int, data: dict) -> Dict[str, tuple]:
+        """Raw matches (group tuples) of the still-empty fields whose rules apply to this page."""
+        found = {}
+        for field, rule in self.rules.items():
+            if not data.get(field) and rule.applies_to(index, page_count):
+                groups = rule.search(text)
+                if groups:
+                    found[field] = groups
+        return found
+
+
+class TemplateRegistry:
+    """
+    Vendor templates loaded from a JSON file (see vendor_templates.example.json), indexed by
+    vendor tax id and by sender domain so a lookup is a dict access.
+    A missing file means an empty registry: every invoice uses the generic extractor.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or os.getenv("EXTRACTION_TEMPLATES_PATH", "vendor_templates.json")
+        self.by_tax_id: Dict[str, VendorTemplate] = {}
+        self.by_domain: Dict[str, VendorTemplate] = {}
+        # Changes whenever the templates file does; part of the extraction cache key
+        self.version = "none"
+
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            content = f.read()
+        self.version = hashlib.sha256(content).hexdigest()[:12]
+        specs = json.loads(content.decode("utf-8")).get("templates", [])
+
+        for spec in specs:
+            template = VendorTemplate(spec)
+            for tax_id in template.tax_ids:
+                self.by_tax_id[tax_id] = template
+            for domain in template.sender_domains:
+                self.by_domain[domain] = template
+        print(f"Loaded {len(specs)} vendor template(s) from {self.path}")
+
+    def __len__(self):
+        return len(set(map(id, self.by_tax_id.values())) | set(map(id, self.by_domain.values())))
+
+    def match(self, tax_id: str = None, sender: str = None) -> Optional[VendorTemplate]:
+        """The template for a vendor tax id, else for the sender's domain (or a parent domain)."""
+        if tax_id and tax_id in self.by_tax_id:
+            return self.by_tax_id[tax_id]
+
+        if sender and self.by_domain:
+            domain = sender.rpartition("@")[2].lower()
+            # mail.vendor.hu also matches a template for vendor.hu
+            while domain:
+                if domain in self.by_domain:
+                    return self.by_domain[domain]
+                domain = domain.partition(".")[2]
+        return None